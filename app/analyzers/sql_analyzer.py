@@ -1,91 +1,483 @@
+import io
 import os
 import json
 import time
+import pickle
+import pstats
+import cProfile
+import shutil
+import tempfile
+import functools
+import itertools
+import collections
 import numpy as np
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
 
 from helpers import plotter
-from helpers.print_tools import print, print_progress
-from helpers.metrics_extractor import read_metrics
+from helpers import timing
+from helpers.batch import Batch, BatchStats
+from helpers.print_tools import print, Progress, disable_progress, \
+    print_logs
+from helpers.metrics_extractor import MetricsConverter
 from helpers.outliers_detection import outlier_detection
+from helpers.model_store import ModelStore, StoredModel
+from helpers.streaming_detection import StreamingDetector
+from helpers.render_pool import RenderPool, RenderJobs
+from helpers.plot_index import PlotIndex, CollectedPlots
+from helpers.outlier_sinks import OutlierSinks, CollectedOutliers, \
+    outlier_document, DEFAULT_OUTPUTS
+from helpers.utils import close_all
 
 
-def perform_analysis(reader, settings):
+# Plots drawn during the analysis (plotting.render), the others are
+# drawn by the web viewer from their histogram data when they're opened
+RENDER = ['all', 'outliers', 'none']
+PLOT_FORMATS = ['svg', 'png']
+
+
+def perform_analysis(reader, settings, workers=1, profile=False):
+    '''
+    Params
+    ======
+    - reader   (Reader): Reader used to run the SQL query
+    - settings   (dict): Settings of the model
+    - workers     (int): Number of processes detecting the outliers,
+                         the batches (buckets) are sent to the processes
+                         while the reader keeps streaming the next ones
+    - profile    (bool): Run the model in cProfile, the statistics are
+                         saved in _profile.prof (next to _general.json)
+
+    The time spent in each stage is printed at the end of the model,
+    and saved in _timing.json
+    '''
     plot_directory = f"../{settings['plotting']['output']}/{settings['name']}"
 
     # Save current config
     settings['run_time'] = time.time()
-    if not os.path.exists(plot_directory):
-        os.mkdir(plot_directory)
+    # Several models can be run in parallel
+    os.makedirs(plot_directory, exist_ok=True)
     output = open(plot_directory + '/_general.json', 'w')
     output.write(json.dumps(settings))
     output.close()
 
+    if settings.get('combine', 'union') not in ['union', 'intersection']:
+        raise Exception('Wrong value [%s] for [combine] accept: %s'
+                        % (settings['combine'], ['union', 'intersection']))
+
+    render = settings['plotting'].get('render', 'all')
+    if render not in RENDER:
+        raise Exception('Wrong value [%s] for [plotting.render] accept: %s'
+                        % (render, RENDER))
+
+    plot_format = settings['plotting'].get('format', 'svg')
+    if plot_format not in PLOT_FORMATS:
+        raise Exception('Wrong value [%s] for [plotting.format] accept: %s'
+                        % (plot_format, PLOT_FORMATS))
+
     str_targets = settings['targets']
     settings = _convert_cols_name_to_index(reader, settings)
-    n_rows = reader.n_rows(settings['sql_query'])
 
-    i_row = 0
+    # Do not scroll the whole query twice just to show a progress bar
+    n_rows = None
+    if reader.can_count_rows(settings['sql_query']):
+        n_rows = reader.n_rows(settings['sql_query'])
+
+    converter = MetricsConverter(settings['metrics'])
+
+    executor = None
+    pending = collections.deque()
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=disable_progress
+        )
+
+    sinks = OutlierSinks(
+        settings.get('outputs', DEFAULT_OUTPUTS),
+        plot_directory
+    )
+
+    # The plots are drawn in background
+    renderer = None
+    if (settings['plotting']['enable'] and render != 'none'
+            and settings['plotting'].get('workers', 1) > 0):
+        renderer = RenderPool(settings['plotting'].get('workers', 1))
+
+    # Metadata of the plots, used by the web viewer
+    index = PlotIndex(plot_directory)
+
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    with timing.recording() as timings:
+        progress = Progress(n_rows)
+
+        try:
+            for bucket, rows in reader.sql_query_bucket(
+                settings['sql_query'],
+                settings['bucket']
+            ):
+                timings.bucket = '-'.join(map(str, bucket))
+                batches = _read_batches(rows, converter, settings, progress)
+
+                # The statistics are computed on the whole bucket, then
+                # the batches are scored against them
+                detectors = [
+                    StreamingDetector(options) if options.get('streaming')
+                    else None for options in _detection_methods(settings)
+                ]
+                if any(detectors):
+                    batches = _spill_batches(batches, detectors)
+
+                for i_batch, batch in enumerate(batches):
+                    if executor is None:
+                        _process_batch(batch, bucket, i_batch, settings,
+                                       plot_directory, str_targets, detectors,
+                                       renderer, sinks, index)
+
+                    else:
+                        # Bounded queue: wait for the oldest batch if the
+                        # workers are late, to keep the memory bounded
+                        if len(pending) >= 2 * workers:
+                            _print_logs(pending.popleft(), renderer, sinks,
+                                        index)
+
+                        pending.append(executor.submit(
+                            _process_batch_worker, batch, bucket, i_batch,
+                            settings, plot_directory, str_targets, detectors,
+                            renderer is not None
+                        ))
+
+                        # Print the logs in order
+                        while pending and pending[0].done():
+                            _print_logs(pending.popleft(), renderer, sinks,
+                                        index)
+
+                    # Clear the memory
+                    del batch
+
+            while pending:
+                _print_logs(pending.popleft(), renderer, sinks, index)
+
+        finally:
+            # Also on error, the processes are stopped, and the outliers
+            # and plots already collected are written (each one is
+            # closed even if the previous ones failed)
+            closers = []
+            if executor is not None:
+                closers.append(executor.shutdown)
+
+            # Write the last outliers and plots
+            closers += [sinks.close, index.close]
+
+            if renderer is not None:
+                closers.append(functools.partial(_close_renderer, renderer))
+
+            close_all(closers)
+
+        progress.end()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(plot_directory + '/_profile.prof')
+        _print_profile(profiler)
+
+    _report_timings(timings, progress, plot_directory)
+
+
+def _close_renderer(renderer):
+    '''
+    Wait for the last plots
+    '''
+    with timing.stage('plot'):
+        renderer.close()
+
+
+def _read_batches(rows, converter, settings, progress):
+    '''
+    Read the rows of a bucket, and yield them by batch
+    (the batches where all the rows are ignored are skipped)
+
+    Params
+    ======
+    - rows                  (iter): Rows of the bucket
+    - converter (MetricsConverter): Converter of the model
+    - settings              (dict): Settings of the model
+    - progress          (Progress): Progress of the model
+    '''
+    i_batch = 0
+    while True:
+        raw_rows = []
+        progress.prefix = 'Batch %i' % i_batch
+
+        # Read by chunks, the progress is not updated for each row
+        while len(raw_rows) < settings['batch_size']:
+            with timing.stage('read'):
+                chunk = list(itertools.islice(rows, min(
+                    progress.every,
+                    settings['batch_size'] - len(raw_rows)
+                )))
+            if not chunk:
+                break
+
+            raw_rows.extend(chunk)
+            progress.update(len(chunk))
+
+        # It was the last batch
+        if not raw_rows:
+            return
+
+        with timing.stage('metrics'):
+            columns = converter.convert(raw_rows)
+
+        timing.count('rows_fetched', len(raw_rows))
+        timing.count('rows_dropped', len(raw_rows) - len(columns[0]))
+        del raw_rows
+
+        # Everything was skipped
+        if not len(columns[0]):
+            continue
+
+        yield Batch(columns, settings['targets'])
+        i_batch += 1
+
+
+def _spill_batches(batches, detectors):
+    '''
+    First pass of the streaming detection: update the detectors with
+    all the batches, which are stored in a temporary directory and
+    read back one by one for the second pass (the memory stays bounded)
+    '''
+    directory = tempfile.mkdtemp(prefix='outliers_')
+
+    try:
+        n_batches = 0
+        for batch in batches:
+            for detector in detectors:
+                if detector is not None:
+                    detector.update(batch.data)
+
+            path = os.path.join(directory, '%i.pickle' % n_batches)
+            with open(path, 'wb') as output:
+                pickle.dump(batch, output, pickle.HIGHEST_PROTOCOL)
+            n_batches += 1
 
-    for bucket, rows in reader.sql_query_bucket(
-        settings['sql_query'],
-        settings['bucket']
-    ):
-        read_batch = True
-        i_batch = 0
-        while read_batch:
-            batch_rows = []
+        for i_batch in range(n_batches):
+            path = os.path.join(directory, '%i.pickle' % i_batch)
+            with open(path, 'rb') as spilled:
+                batch = pickle.load(spilled)
+            os.remove(path)
 
-            for i, row in enumerate(rows):
-                print_progress(i_row, n_rows, prefix='Batch %i' % i_batch)
-                i_row += 1
-                row = read_metrics(row, settings['metrics'])
+            yield batch
 
-                # We must ignore this row
-                if row is None or None in row:
-                    continue
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
-                batch_rows.append(row)
 
-                if i >= settings['batch_size']:
-                    break
+def _process_batch(batch, bucket, i_batch, settings,
+                   plot_directory, str_targets, detectors=None,
+                   renderer=None, sinks=None, index=None):
+    '''
+    Detect, report and plot the outliers of a batch
+    If detectors are given (streaming detection), the outliers of the
+    methods having one are detected against its statistics
+    If a renderer is given (RenderPool), the plot is drawn by it
+    The outliers are sent to the sinks (OutlierSinks), and the plot
+    to the index (PlotIndex)
+    '''
+    with timing.stage('detection'):
+        found = _detect(batch, bucket, i_batch, settings, detectors)
+        outliers = _combine(found, settings.get('combine', 'union'))
+
+    timing.count('batches')
+    timing.count('outliers', len(outliers))
+
+    # The outliers of each method are reported when there are several
+    labels = _method_labels(settings)
+    methods = None
+    if len(found) > 1:
+        methods = list(zip(labels, found))
+
+    with timing.stage('report'):
+        process_outliers(batch, outliers, settings, methods, bucket, i_batch,
+                         sinks)
+
+    if 'plotting' in settings and settings['plotting']['enable']:
+        prefix = '*' if len(outliers) else ''
+        render = settings['plotting'].get('render', 'all')
+        with timing.stage('plot'):
+            plotter.histogram(
+                batch.data,
+                outliers,
+                labels=['Data', 'Outliers'],
+                groups=methods,
+                filename=(plot_directory + f"/{prefix}{'-'.join(bucket)}"
+                          + f"[{str(i_batch)}]"),
+                title=(settings['name']
+                       + (' | ' + '-'.join(bucket)) if settings['bucket']
+                       else settings['name']),
+                xlabel=' - '.join(str_targets) + ' | ' + ', '.join(labels),
+                render=(render == 'all'
+                        or (render == 'outliers' and len(outliers) > 0)),
+                format=settings['plotting'].get('format', 'svg'),
+                renderer=renderer,
+                index=index
+            )
+
+
+def _detection_methods(settings):
+    '''
+    Return
+    ======
+    The list of detection settings of the model ('detection' can be
+    one method or a list of methods)
+    '''
+    if isinstance(settings['detection'], list):
+        return settings['detection']
+
+    return [settings['detection']]
+
+
+def _method_labels(settings):
+    '''
+    Name of each detection method, numbered if a method is used twice
+    '''
+    names = [options['method'] for options in _detection_methods(settings)]
+
+    return [
+        name if names.count(name) == 1
+        else '%s #%i' % (name, names[:i].count(name) + 1)
+        for i, name in enumerate(names)
+    ]
 
-            else:
-                # It was the last batch
-                read_batch = False
 
-            # Everything was skipped
-            if not batch_rows:
-                continue
+def _detect(batch, bucket, i_batch, settings, detectors=None):
+    '''
+    Run all the detection methods of the model on the batch, the
+    statistics of the batch are computed once for all the methods
+
+    Return
+    ======
+    The index of the outliers found by each method
+    '''
+    methods = _detection_methods(settings)
+    detectors = detectors or [None] * len(methods)
+    stats = BatchStats(batch.data)
 
-            batch_rows = np.array(batch_rows, dtype='object')
+    found = []
+    for options, detector in zip(methods, detectors):
+        if detector is not None:
+            found.append(detector.outliers(batch.data))
+            continue
 
-            outliers = outlier_detection(
-                batch_rows[:, settings['targets']],
-                settings['detection']
+        # The estimators fitted by the previous runs are reused until
+        # they are too old
+        model = None
+        if 'refit_every' in options:
+            model = StoredModel(
+                ModelStore(options.get('model_store', '../models')),
+                settings['name'],
+                bucket,
+                i_batch,
+                options,
+                options['refit_every'],
+                run_time=settings['run_time']
             )
 
-            process_outliers(batch_rows, outliers, settings)
+        found.append(outlier_detection(batch.data, options,
+                                       model=model, stats=stats))
+
+    return found
+
+
+def _combine(found, combine='union'):
+    '''
+    Return
+    ======
+    The index of the rows found by any method (union),
+    or by all the methods (intersection)
+    '''
+    if len(found) == 1:
+        return found[0]
+
+    found = [np.asarray(outliers, dtype=np.int64) for outliers in found]
+
+    if combine == 'intersection':
+        return functools.reduce(np.intersect1d, found)
+
+    return np.unique(np.concatenate(found))
+
+
+def _process_batch_worker(*args):
+    '''
+    Run _process_batch in a worker process, the last argument tells
+    if the plots are sent back to the RenderPool of the analysis
+    (they're drawn in the worker otherwise)
+
+    Return
+    ======
+    The logs, the timings, the plots and the outliers of the batch
+    '''
+    *args, send_plots = args
+    renderer = RenderJobs() if send_plots else None
+    sinks = CollectedOutliers()
+    index = CollectedPlots()
+
+    logs = io.StringIO()
+    with redirect_stdout(logs), timing.recording() as timings:
+        timings.bucket = '-'.join(map(str, args[1]))
+        _process_batch(*args, renderer=renderer, sinks=sinks, index=index)
+
+    return (logs.getvalue(), timings.to_dict(),
+            renderer.jobs if renderer is not None else [], sinks.batches,
+            index.plots)
+
+
+def _print_logs(future, renderer=None, sinks=None, index=None):
+    logs, timings, plots, outliers, indexed = future.result()
+    timing.current().merge(timings)
+    if logs:
+        print_logs(logs)
+
+    for summary, documents in outliers:
+        sinks.add(summary, documents)
 
-            if 'plotting' in settings and settings['plotting']['enable']:
-                prefix = '*' if len(outliers) else ''
-                plotter.histogram(
-                    batch_rows[:, settings['targets']],
-                    outliers,
-                    labels=['Data', 'Outliers'],
-                    filename=(plot_directory + f"/{prefix}{'-'.join(bucket)}"
-                              + f"[{str(i_batch)}]"),
-                    title=(settings['name']
-                           + (' | ' + '-'.join(bucket)) if settings['bucket']
-                           else settings['name']),
-                    xlabel=(' - '.join(str_targets) + ' | '
-                            + settings['detection']['method'])
-                )
+    for hist, filename in plots:
+        renderer.submit(hist, filename)
 
-            i_batch += 1
+    for metadata in indexed:
+        index.add(metadata)
 
-            # Clear the memory
-            del batch_rows
-            del outliers
+
+def _report_timings(timings, progress, plot_directory):
+    '''
+    Print the time spent in each stage, and save it in _timing.json
+    The stages of the reader run in background (prefetch), they can
+    overlap with the other stages
+    '''
+    elapsed = time.time() - progress.start
+    print('Time per stage\n' + timings.table(elapsed), type='debug')
+
+    report = timings.to_dict()
+    report['elapsed'] = elapsed
+    report['rows_per_second'] = progress.count / elapsed if elapsed else 0
+
+    output = open(plot_directory + '/_timing.json', 'w')
+    output.write(json.dumps(report))
+    output.close()
+
+
+def _print_profile(profiler, n_functions=20):
+    '''
+    Print the functions where the most time was spent
+    '''
+    logs = io.StringIO()
+    stats = pstats.Stats(profiler, stream=logs)
+    stats.sort_stats('cumulative').print_stats(n_functions)
+    print(logs.getvalue(), type='debug')
 
 
 def _convert_cols_name_to_index(reader, settings):
@@ -93,6 +485,8 @@ def _convert_cols_name_to_index(reader, settings):
     Modify settings to use index and not the column name
     '''
     cols = reader.columns(settings['sql_query'])
+    # Names of the values of the outliers (see outlier_document)
+    settings['columns'] = list(cols)
     cols = {c: i for i, c in enumerate(cols)}
     settings['bucket'] = [cols[b] for b in settings['bucket']]
     settings['targets'] = [cols[b] for b in settings['targets']]
@@ -105,21 +499,50 @@ def _convert_cols_name_to_index(reader, settings):
     return settings
 
 
-def process_outliers(rows, outliers, settings):
+def process_outliers(batch, outliers, settings, methods=None, bucket=(),
+                     i_batch=0, sinks=None):
     '''
     Params
     ======
-    - rows (np.array): Rows returned by the SQL query
-    - outliers (list): List of index considered to be outliers
+    - batch    (Batch): Rows returned by the SQL query
+    - outliers  (list): List of index considered to be outliers
+    - methods   (list): (name, outliers) of each detection method,
+                        if the model has several
+    - bucket    (list): Bucket of the batch
+    - i_batch    (int): Index of the batch in the bucket
+    - sinks (OutlierSinks): Where the outliers are sent, printed
+                            if None
     '''
     if not len(outliers):
         return
 
-    print('Number of elements: ', rows.shape[0])
-    print('Number of outliers:', len(outliers))
-    print('Contamination: %.2f%%' % (len(outliers) * 100 / rows.shape[0]))
+    if sinks is None:
+        sinks = OutlierSinks([{'type': 'console', 'max_outliers': None,
+                               'interval': 0}], None)
+
+    summary = {
+        'n_rows': len(batch),
+        'n_outliers': len(outliers),
+        'methods': None
+    }
+
+    if methods is not None:
+        summary['methods'] = {name: len(found) for name, found in methods}
+        methods = [(name, set(found)) for name, found in methods]
 
     outlier_message = settings['outlier_message']
+    documents = []
     for outlier in outliers:
-        print('    ', outlier_message['title'])
-        print('    ', outlier_message['content'].format(*rows[outlier, :]))
+        title = outlier_message['title']
+        found_by = None
+        if methods is not None:
+            found_by = [name for name, found in methods if outlier in found]
+            title += ' [%s]' % ', '.join(found_by)
+
+        row = batch.row(outlier)
+        documents.append(outlier_document(
+            settings, bucket, i_batch, int(outlier), title,
+            outlier_message['content'].format(*row), row, found_by
+        ))
+
+    sinks.add(summary, documents)
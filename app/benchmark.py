@@ -0,0 +1,346 @@
+import io
+import os
+import glob
+import json
+import time
+import platform
+import argparse
+import subprocess
+from contextlib import redirect_stdout
+
+import numpy as np
+import sklearn
+
+from readers.es_reader import ES
+from readers.synthetic_reader import SyntheticReader, synthetic_values, \
+    DISTRIBUTIONS
+from es_server import ESStandIn, synthetic_rows
+from helpers.outliers_detection import outlier_detection
+from helpers.print_tools import print, disable_progress, intro_message
+from analyzers import sql_analyzer
+
+
+# (name, detection settings, maximum number of rows or None)
+# the slow detectors are not run on the biggest sizes
+DETECTORS = [
+    ('stdev', {'method': 'stdev', 'sensitivity': 3}, None),
+    ('z_score', {'method': 'z_score', 'sensitivity': 3}, None),
+    ('mad', {'method': 'mad', 'sensitivity': 3}, None),
+    ('percentile', {'method': 'percentile', 'sensitivity': 99,
+                    'trigger_on': 'high'}, None),
+    ('pct_of_avg_value', {'method': 'pct_of_avg_value', 'sensitivity': 300,
+                          'trigger_on': 'high'}, None),
+    ('pct_of_max_value', {'method': 'pct_of_max_value', 'sensitivity': 50,
+                          'trigger_on': 'high'}, None),
+    ('pct_of_min_value', {'method': 'pct_of_min_value', 'sensitivity': 200,
+                          'trigger_on': 'low'}, None),
+    ('pct_of_median_value', {'method': 'pct_of_median_value',
+                             'sensitivity': 50, 'trigger_on': 'high'}, None),
+    ('trigger_all', {'method': 'trigger_all'}, None),
+    ('lof', {'method': 'lof', 'sensitivity': 1, 'n_neighbors': 20},
+     10 ** 5),
+    ('lof_sorted', {'method': 'lof', 'sensitivity': 1, 'n_neighbors': 20,
+                    'backend': 'sorted'}, None),
+    ('lof_approximate', {'method': 'lof', 'sensitivity': 1,
+                         'n_neighbors': 20, 'backend': 'approximate'},
+     10 ** 6),
+    ('isolation_forest', {'method': 'isolation_forest', 'sensitivity': 35},
+     10 ** 6),
+]
+
+# Slower than the previous results by more than this ratio
+REGRESSION = 1.2
+
+
+def main():
+    args = arg_parse()
+    disable_progress()
+
+    results = {
+        'version': _git_version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'distribution': args['distribution'],
+        'benchmarks': {}
+    }
+
+    for n_rows in args['rows']:
+        print('%i rows' % n_rows, type='title')
+
+        if not args['pipeline_only']:
+            for name, seconds in bench_detectors(n_rows, args):
+                _add(results, name, n_rows, seconds)
+
+        seconds = bench_pipeline(n_rows, args)
+        _add(results, 'perform_analysis', n_rows, seconds)
+
+        if args['reader']:
+            for name, seconds in bench_reader(n_rows, args):
+                _add(results, name, n_rows, seconds)
+
+    previous = _last_results(args['output'])
+    if previous is not None:
+        compare(previous, results)
+
+    os.makedirs(args['output'], exist_ok=True)
+    filename = os.path.join(
+        args['output'],
+        '%s_%s.json' % (time.strftime('%Y%m%d_%H%M%S'), results['version'])
+    )
+    output = open(filename, 'w')
+    output.write(json.dumps(results, indent=4))
+    output.close()
+
+    print('Results saved in %s' % filename)
+
+
+def bench_detectors(n_rows, args):
+    '''
+    Time each detector on n_rows values (best of 'repeat' runs)
+
+    Return
+    ======
+    List of (detector name, seconds)
+    '''
+    data = synthetic_values(n_rows, args['distribution'])
+    timings = []
+
+    for name, options, max_rows in DETECTORS:
+        if max_rows is not None and n_rows > max_rows:
+            continue
+
+        seconds = _best_of(
+            lambda: outlier_detection(data, options),
+            args['repeat']
+        )
+        timings.append((name, seconds))
+        _print_result(name, n_rows, seconds)
+
+    return timings
+
+
+def bench_pipeline(n_rows, args):
+    '''
+    Time sql_analyzer.perform_analysis end to end on a SyntheticReader
+    (the plots are disabled, the logs are dropped)
+    '''
+    def run():
+        reader = SyntheticReader(
+            n_rows,
+            n_buckets=args['buckets'],
+            distribution=args['distribution']
+        )
+        settings = {
+            'name': 'benchmark',
+            'sql_query': 'SELECT bucket, value, label FROM synthetic',
+            'bucket': ['bucket'],
+            'metrics': ['str', 'float', 'str'],
+            'targets': ['value'],
+            'batch_size': args['batch_size'],
+            'detection': {'method': 'stdev', 'sensitivity': 3},
+            'outlier_message': {
+                'title': 'Outlier',
+                'content': '{bucket}: {value}'
+            },
+            # Same output as the previous results (no jsonl file)
+            'outputs': [{'type': 'console'}],
+            'plotting': {
+                'enable': False,
+                # _general.json and _timing.json of the run
+                'output': os.path.relpath(
+                    os.path.join(args['output'], 'run'), '..')
+            }
+        }
+
+        with redirect_stdout(io.StringIO()):
+            sql_analyzer.perform_analysis(reader, settings)
+
+    seconds = _best_of(run, 1)
+    _print_result('perform_analysis', n_rows, seconds)
+
+    return seconds
+
+
+def bench_reader(n_rows, args):
+    '''
+    Time the ES reader (with and without prefetch)
+    against a local ESStandIn server, for each simulated latency
+
+    Return
+    ======
+    List of (benchmark name, seconds)
+    '''
+    columns, rows = synthetic_rows(n_rows, args['buckets'],
+                                   args['distribution'])
+    sql_query = 'SELECT bucket, value, label FROM synthetic ORDER BY bucket'
+    timings = []
+
+    for latency in args['latency']:
+        server = ESStandIn(('127.0.0.1', 0), columns, rows,
+                           latency=latency).start()
+
+        for prefetch in [0, 2]:
+            reader = ES(server.url, args['page_size'], '90s',
+                        prefetch=prefetch)
+
+            name = 'es_json_prefetch%i_%ims' % (prefetch, latency * 1000)
+            seconds = _best_of(
+                lambda: sum(1 for _ in reader.sql_query(sql_query)), 1)
+
+            timings.append((name, seconds))
+            _print_result(name, n_rows, seconds)
+            reader.close()
+
+        server.shutdown()
+        server.server_close()
+
+    return timings
+
+
+def compare(previous, results):
+    '''
+    Print the ratio between the current and the previous results
+    '''
+    print('Compared to %s (%s)' % (previous['version'], previous['date']),
+          type='title')
+
+    for name, timings in results['benchmarks'].items():
+        for n_rows, seconds in timings.items():
+            before = previous['benchmarks'].get(name, {}).get(n_rows)
+            if not before or not seconds:
+                continue
+
+            ratio = seconds / before
+            print('%-24s %10s rows  x%.2f' % (name, n_rows, ratio),
+                  type='warning' if ratio > REGRESSION else 'info')
+
+
+def _add(results, name, n_rows, seconds):
+    # The keys of a json object are strings
+    results['benchmarks'].setdefault(name, {})[str(n_rows)] = seconds
+
+
+def _best_of(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best
+
+
+def _print_result(name, n_rows, seconds):
+    print('%-24s %10.4fs  %12i rows/s'
+          % (name, seconds, n_rows / seconds if seconds else 0))
+
+
+def _last_results(directory):
+    filenames = sorted(glob.glob(os.path.join(directory, '*.json')))
+    if not filenames:
+        return None
+
+    return json.load(open(filenames[-1]))
+
+
+def _git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def arg_parse():
+    '''
+    Parse the arguments
+
+    Return
+    ======
+    dict[arg_name]
+    '''
+    arg_parser = argparse.ArgumentParser(description='Benchmark')
+
+    arg_parser.add_argument(
+        '--rows',
+        help='Number of rows of each run',
+        type=int,
+        nargs='+',
+        default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+    )
+
+    arg_parser.add_argument(
+        '--distribution',
+        help='Distribution of the values',
+        choices=DISTRIBUTIONS,
+        default='lognormal'
+    )
+
+    arg_parser.add_argument(
+        '--buckets',
+        help='Number of buckets of the end to end run',
+        type=int,
+        default=10
+    )
+
+    arg_parser.add_argument(
+        '--batch-size',
+        help='Batch size of the end to end run',
+        dest='batch_size',
+        type=int,
+        default=100000
+    )
+
+    arg_parser.add_argument(
+        '--repeat',
+        help='Number of runs of each detector (the best time is kept)',
+        type=int,
+        default=3
+    )
+
+    arg_parser.add_argument(
+        '--pipeline-only',
+        help='Only time perform_analysis',
+        dest='pipeline_only',
+        action='store_true'
+    )
+
+    arg_parser.add_argument(
+        '--reader',
+        help='Time the ES reader against a local stand-in server',
+        action='store_true'
+    )
+
+    arg_parser.add_argument(
+        '--latency',
+        help='Simulated latencies of the server, in seconds (--reader)',
+        type=float,
+        nargs='+',
+        default=[0, 0.01]
+    )
+
+    arg_parser.add_argument(
+        '--page-size',
+        help='Number of rows per page (--reader)',
+        dest='page_size',
+        type=int,
+        default=10000
+    )
+
+    arg_parser.add_argument(
+        '--output',
+        help='Directory of the results',
+        default='../benchmarks'
+    )
+
+    return vars(arg_parser.parse_args())
+
+
+if __name__ == '__main__':
+    intro_message()
+    main()
@@ -0,0 +1,339 @@
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from readers.synthetic_reader import SyntheticReader, DISTRIBUTIONS
+from helpers.print_tools import print, intro_message
+
+
+class ESStandIn(ThreadingHTTPServer):
+    '''
+    Local HTTP server answering the /_xpack/sql requests of the ES reader
+    with the same rows, whatever the query (except SELECT COUNT(*) FROM),
+    and the _bulk requests of the ES writer (the documents are kept in
+    memory, by index and id)
+
+    Used to test the reader (paging, prefetch, cursors) and the writer
+    without Elasticsearch, with a simulated network latency
+
+    Params
+    ======
+    - address     (tuple): (host, port), port 0 for a free port
+    - columns      (list): {'name': column name, 'type': ES type}
+    - rows         (list): Rows returned
+    - latency     (float): Seconds to wait before answering a request
+    - page_size     (int): Maximum number of rows per page, None to
+                           use the fetch_size of the query
+    - error_rate  (float): Fraction of the pages (and of the _bulk
+                           requests) answered with an error
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, columns, rows, latency=0., page_size=None,
+                 error_rate=0.):
+        super().__init__(address, _Handler)
+        self.columns = columns
+        self.rows = rows
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+
+        # cursor: [offset, page size]
+        self.cursors = {}
+        # index: {id: document}
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.n_requests = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%i' % self.server_address[:2]
+
+    def start(self):
+        '''
+        Serve in a background thread
+
+        Usage
+        =====
+        server = ESStandIn(('127.0.0.1', 0), columns, rows).start()
+        reader = ES(server.url)
+        ...
+        server.shutdown()
+        '''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+        return self
+
+    def answer(self, body):
+        '''
+        Return
+        ======
+        (HTTP status, response)
+        '''
+        with self.lock:
+            self.n_requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            return 500, {'error': 'Simulated error'}
+
+        if 'cursor' in body:
+            with self.lock:
+                page = self.cursors.pop(body['cursor'], None)
+            if page is None:
+                return 404, {'error': 'Unknown cursor'}
+            offset, page_size = page
+
+        # Count query of the reader (see ES._count_query), the queries
+        # selecting COUNT(*) with other columns return the rows
+        elif re.match(r'^\s*SELECT\s+COUNT\(\*\)\s+FROM\b',
+                      body.get('query', ''), re.IGNORECASE):
+            return 200, {
+                'columns': [{'name': 'COUNT(*)', 'type': 'long'}],
+                'rows': [[len(self.rows)]]
+            }
+
+        else:
+            offset = 0
+            page_size = self.page_size or body.get('fetch_size', 1000)
+
+        # Filter used by the reader to get the columns only
+        if 'filter' in body:
+            rows = []
+        else:
+            rows = self.rows[offset:offset + page_size]
+
+        response = {'rows': rows}
+        if not offset:
+            response['columns'] = self.columns
+
+        if rows and offset + page_size < len(self.rows):
+            cursor = uuid.uuid4().hex
+            with self.lock:
+                self.cursors[cursor] = [offset + page_size, page_size]
+            response['cursor'] = cursor
+
+        return 200, response
+
+    def bulk(self, lines):
+        '''
+        Index the documents of a _bulk request (index actions only)
+        '''
+        with self.lock:
+            self.n_requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            return 500, {'error': 'Simulated error'}
+
+        items = []
+        for action, document in zip(lines[::2], lines[1::2]):
+            action = json.loads(action)['index']
+            doc_id = action.get('_id', uuid.uuid4().hex)
+
+            with self.lock:
+                documents = self.documents.setdefault(action['_index'], {})
+                result = 'updated' if doc_id in documents else 'created'
+                documents[doc_id] = json.loads(document)
+
+            items.append({'index': {
+                '_index': action['_index'],
+                '_id': doc_id,
+                'result': result,
+                'status': 201 if result == 'created' else 200
+            }})
+
+        return 200, {'errors': False, 'items': items}
+
+    def close_cursor(self, body):
+        with self.lock:
+            found = self.cursors.pop(body.get('cursor'), None) is not None
+
+        return 200, {'succeeded': found}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, the reader reuses its connections
+    protocol_version = 'HTTP/1.1'
+    # Headers and body sent at once (no delayed ACK between them)
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+
+        if url.path == '/_bulk':
+            status, response = self.server.bulk(
+                data.decode('utf-8').splitlines())
+            self._send(status, json.dumps(response), 'application/json')
+            return
+
+        body = json.loads(data or b'{}')
+
+        if url.path == '/_xpack/sql/close':
+            status, response = self.server.close_cursor(body)
+
+        elif url.path == '/_xpack/sql':
+            status, response = self.server.answer(body)
+
+        else:
+            status, response = 404, {'error': 'Not found'}
+
+        self._send(status, json.dumps(response), 'application/json')
+
+    def _send(self, status, text, content_type):
+        data = text.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_rows(filename):
+    '''
+    Load the rows served from a json file, with the same shape as
+    an ES response: {"columns": [{"name": .., "type": ..}], "rows": [..]}
+
+    Return
+    ======
+    (columns, rows)
+    '''
+    data = json.load(open(filename))
+
+    if 'columns' not in data or 'rows' not in data:
+        raise Exception('Wrong file [%s], "columns" and "rows" are required'
+                        % filename)
+
+    return data['columns'], data['rows']
+
+
+def synthetic_rows(n_rows, n_buckets=10, distribution='normal'):
+    '''
+    Return
+    ======
+    (columns, rows) generated by a SyntheticReader
+    '''
+    reader = SyntheticReader(n_rows, n_buckets=n_buckets,
+                             distribution=distribution)
+    types = ['keyword', 'double', 'keyword']
+    columns = [
+        {'name': name, 'type': col_type}
+        for name, col_type in zip(reader.columns(''), types)
+    ]
+
+    return columns, [list(row) for row in reader.sql_query('')]
+
+
+def main():
+    args = arg_parse()
+
+    if args['file'] is not None:
+        columns, rows = load_rows(args['file'])
+    else:
+        columns, rows = synthetic_rows(
+            args['rows'], args['buckets'], args['distribution'])
+
+    server = ESStandIn(
+        (args['host'], args['port']),
+        columns,
+        rows,
+        latency=args['latency'],
+        page_size=args['page_size'],
+        error_rate=args['error_rate']
+    )
+
+    print('Serving %i rows on %s' % (len(rows), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('%i requests, %i cursors not closed'
+              % (server.n_requests, len(server.cursors)))
+
+
+def arg_parse():
+    '''
+    Parse the arguments
+
+    Return
+    ======
+    dict[arg_name]
+    '''
+    arg_parser = argparse.ArgumentParser(
+        description='Local stand-in of the Elasticsearch SQL API'
+    )
+
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=9200)
+
+    arg_parser.add_argument(
+        '--file',
+        help='Json file of the rows ({"columns": [..], "rows": [..]}), '
+             'random rows are generated if not given'
+    )
+
+    arg_parser.add_argument(
+        '--rows',
+        help='Number of random rows',
+        type=int,
+        default=100000
+    )
+
+    arg_parser.add_argument(
+        '--buckets',
+        help='Number of buckets of the random rows',
+        type=int,
+        default=10
+    )
+
+    arg_parser.add_argument(
+        '--distribution',
+        help='Distribution of the random values',
+        choices=DISTRIBUTIONS,
+        default='normal'
+    )
+
+    arg_parser.add_argument(
+        '--latency',
+        help='Seconds to wait before answering a request',
+        type=float,
+        default=0.
+    )
+
+    arg_parser.add_argument(
+        '--page-size',
+        help='Maximum number of rows per page (default: fetch_size)',
+        dest='page_size',
+        type=int
+    )
+
+    arg_parser.add_argument(
+        '--error-rate',
+        help='Fraction of the pages answered with an error',
+        dest='error_rate',
+        type=float,
+        default=0.
+    )
+
+    return vars(arg_parser.parse_args())
+
+
+if __name__ == '__main__':
+    intro_message()
+    main()
@@ -0,0 +1,137 @@
+import numpy as np
+from functools import wraps
+
+
+class Batch:
+    '''
+    Columns of a batch of rows
+
+    The targets are stored in one contiguous float64 array used by the
+    detectors, the other columns are only used to display the outliers
+
+    Params
+    ======
+    - columns (list): np.array per column (see MetricsConverter)
+    - targets (list): Index of the target columns
+    '''
+    def __init__(self, columns, targets):
+        self.columns = columns
+        self.targets = np.empty((len(columns[0]), len(targets)), np.float64)
+        for i, target in enumerate(targets):
+            self.targets[:, i] = columns[target]
+
+    def __len__(self):
+        return self.targets.shape[0]
+
+    @property
+    def data(self):
+        '''
+        Targets given to the detectors, a 1D view if
+        there is only one target (no copy is made)
+        '''
+        if self.targets.shape[1] == 1:
+            return self.targets.reshape(-1)
+
+        return self.targets
+
+    def row(self, index):
+        '''
+        Return the converted values of a row
+        '''
+        return [column[index] for column in self.columns]
+
+
+def _memoized(function):
+    '''
+    Read only property computed on its first use
+    '''
+    @wraps(function)
+    def getter(self):
+        if function.__name__ not in self._values:
+            self._values[function.__name__] = function(self)
+
+        return self._values[function.__name__]
+
+    return property(getter)
+
+
+class BatchStats:
+    '''
+    Statistics of the targets of a batch, computed on their first use,
+    so the detectors run on the same batch compute them once
+
+    Params
+    ======
+    - data (np.array): Targets of the batch (one target)
+
+    Usage
+    =====
+    stats = BatchStats(batch.data)
+    stats.median, stats.mad, stats.percentile(95)
+    '''
+    def __init__(self, data):
+        self.data = data.reshape(-1)
+        self._values = {}
+        self._percentiles = {}
+
+    @_memoized
+    def sorted(self):
+        return np.sort(self.data)
+
+    @_memoized
+    def median(self):
+        values = self.sorted
+        if not values.size or np.isnan(values[-1]):
+            return np.nan
+
+        # Mean of the 2 middle values, like np.median
+        middle = values.size // 2
+        if values.size % 2:
+            return values[middle]
+
+        return values[middle - 1:middle + 1].mean()
+
+    @_memoized
+    def mad(self):
+        return np.median(abs(self.data - self.median))
+
+    @_memoized
+    def mean(self):
+        return self.data.mean()
+
+    @_memoized
+    def std(self):
+        return self.data.std()
+
+    @_memoized
+    def min(self):
+        return self.data.min()
+
+    @_memoized
+    def max(self):
+        return self.data.max()
+
+    def percentile(self, q):
+        if q not in self._percentiles:
+            self._percentiles[q] = _quantile(self.sorted, q / 100)
+
+        return self._percentiles[q]
+
+
+def _quantile(values, q):
+    '''
+    Quantile of sorted values, same interpolation as np.percentile
+    (read from the sorted values, nothing is partitioned)
+    '''
+    if not values.size or np.isnan(values[-1]):
+        return np.nan
+
+    position = q * (values.size - 1)
+    low = int(np.floor(position))
+    high = min(low + 1, values.size - 1)
+    fraction = position - low
+
+    if fraction >= 0.5:
+        return values[high] - (values[high] - values[low]) * (1 - fraction)
+
+    return values[low] + (values[high] - values[low]) * fraction
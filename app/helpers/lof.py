@@ -0,0 +1,194 @@
+import math
+import numpy as np
+from sklearn.neighbors import LocalOutlierFactor
+
+
+class SortedLOF:
+    '''
+    Exact Local Outlier Factor of univariate data, in O(n log n)
+
+    Same scores as LocalOutlierFactor(novelty=True).score_samples
+    (up to the ties between the neighbours), without a KD-tree:
+    - the k nearest neighbours of a value are a window of the sorted
+      data, found with a binary search
+    - the right bound (value + k-distance) of the neighbourhoods is
+      increasing with the value, so the sums of reachability distances
+      over a window are computed with prefix sums
+
+    Params
+    ======
+    - n_neighbors (int): Number of neighbours
+    '''
+    def __init__(self, n_neighbors):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, data):
+        k = self.n_neighbors
+        values = np.sort(np.asarray(data, dtype=np.float64).reshape(-1))
+
+        if values.size <= k:
+            raise ValueError('Expected n_neighbors < n_samples')
+
+        # Neighbours of the fitted values, without themselves
+        starts = _windows(values, values, k + 1)
+        k_distances = _radius(values, values, starts, k + 1)
+
+        self.values = values
+        self.k_distances = k_distances
+        self._prefix_values = _prefix(values)
+        # Both increasing, see the proof in _reach_sums
+        self.rights = np.maximum.accumulate(values + k_distances)
+        self.lefts = np.maximum.accumulate(values - k_distances)
+        self._prefix_rights = _prefix(self.rights)
+        self._prefix_lefts = _prefix(self.lefts)
+
+        # The reachability distance of a value to itself is its k-distance
+        reach = self._reach_sums(values, starts, starts + k + 1)
+        reach -= k_distances
+        self.lrd = 1 / (reach / k + 1e-10)
+        self._prefix_lrd = _prefix(self.lrd)
+
+        return self
+
+    def score_samples(self, data):
+        '''
+        Return
+        ======
+        Opposite of the LOF of each value (the lower, the more abnormal)
+        '''
+        k = self.n_neighbors
+        data = np.asarray(data, dtype=np.float64).reshape(-1)
+
+        starts = _windows(self.values, data, k)
+        ends = starts + k
+
+        lrd = 1 / (self._reach_sums(data, starts, ends) / k + 1e-10)
+        neighbours_lrd = self._prefix_lrd[ends] - self._prefix_lrd[starts]
+
+        return - neighbours_lrd / k / lrd
+
+    def _reach_sums(self, data, starts, ends):
+        '''
+        Sum of the reachability distances of each value of data to the
+        fitted values of its window [start, end)
+
+        reach(x, o) = max(k-distance(o), |x - o|)
+        - o <= x: max(o + k-distance(o), x) - o
+        - o >= x: o - min(o - k-distance(o), x)
+
+        o + k-distance(o) is increasing: if o < o' and o + k(o) > o' + k(o')
+        the interval centered on o with the right bound o' + k(o') contains
+        the neighbourhood of o', so k(o) <= o' + k(o') - o < k(o)
+        (same for o - k-distance(o)), the values where the max (min) is x
+        are at the beginning (end) of the window
+        '''
+        splits = np.clip(np.searchsorted(self.values, data), starts, ends)
+
+        # Left side [start, split)
+        bounds = np.clip(
+            np.searchsorted(self.rights, data, side='right'),
+            starts, splits
+        )
+        left = (data * (bounds - starts)
+                + self._prefix_rights[splits] - self._prefix_rights[bounds]
+                - self._prefix_values[splits] + self._prefix_values[starts])
+
+        # Right side [split, end)
+        bounds = np.clip(np.searchsorted(self.lefts, data), splits, ends)
+        right = (self._prefix_values[ends] - self._prefix_values[splits]
+                 - self._prefix_lefts[bounds] + self._prefix_lefts[splits]
+                 - data * (ends - bounds))
+
+        return left + right
+
+
+class SampledLOF:
+    '''
+    Approximate Local Outlier Factor, for the big multivariate batches
+
+    The estimator is fitted on a random sample of the data, with a
+    number of neighbours reduced in the same proportion (the
+    neighbourhoods keep about the same size) but not below min_neighbors
+    (with 1 or 2 neighbours the scores are mostly noise), then all the
+    rows are scored against it
+
+    The scores are an approximation: on 2 columns with 20 neighbours, the
+    top 1% of the rows shares about 70% of its rows with the exact LOF on
+    10^5 rows (10^4 samples), about 15% on 10^6 rows (the neighbourhoods
+    of the sample are larger)
+
+    Params
+    ======
+    - n_neighbors    (int): Number of neighbours (on the whole data)
+    - max_samples    (int): Size of the sample
+    - min_neighbors  (int): Minimum number of neighbours on the sample
+                            (at most n_neighbors)
+    '''
+    def __init__(self, n_neighbors, max_samples=10000, min_neighbors=20):
+        self.n_neighbors = n_neighbors
+        self.max_samples = max_samples
+        self.min_neighbors = min_neighbors
+
+    def fit(self, data):
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+
+        n_neighbors = self.n_neighbors
+        if data.shape[0] > self.max_samples:
+            # Reproducible sample
+            sample = np.random.RandomState(0).choice(
+                data.shape[0], self.max_samples, replace=False)
+
+            n_neighbors = max(
+                math.ceil(n_neighbors * self.max_samples / data.shape[0]),
+                min(n_neighbors, self.min_neighbors)
+            )
+            data = data[np.sort(sample)]
+
+        self.estimator = LocalOutlierFactor(
+            novelty=True,
+            contamination=0.1,
+            n_neighbors=n_neighbors
+        )
+        self.estimator.fit(data)
+
+        return self
+
+    def score_samples(self, data):
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+
+        return self.estimator.score_samples(data)
+
+
+def _windows(values, data, size):
+    '''
+    Return
+    ======
+    Start of the window of 'size' sorted values closest to each value of
+    data (binary search of all the values at once)
+    '''
+    positions = np.searchsorted(values, data)
+    low = np.clip(positions - size, 0, values.size - size)
+    high = np.clip(positions, 0, values.size - size)
+
+    for _ in range(size.bit_length() + 1):
+        middle = (low + high) // 2
+        # The window starting at middle + 1 is closer
+        following = values[np.minimum(middle + size, values.size - 1)]
+        closer = (data - values[middle] > following - data) & (middle < high)
+        low = np.where(closer, middle + 1, low)
+        high = np.where(closer, high, middle)
+
+    return low
+
+
+def _radius(values, data, starts, size):
+    '''
+    Distance between each value of data and the farthest value of its window
+    '''
+    return np.maximum(data - values[starts], values[starts + size - 1] - data)
+
+
+def _prefix(values):
+    return np.concatenate([[0.], np.cumsum(values)])
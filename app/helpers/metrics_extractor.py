@@ -1,43 +1,302 @@
 import re
+import time
 import base64
+import itertools
+import numpy as np
 from datetime import date, datetime
 
 
-def read_metrics(values, metrics):
+class MetricsConverter:
     '''
-    Convert the input value to the metric
-    If return None, the row must be ignored !
+    Convert the rows returned by a reader to typed columns
+
+    The metrics are compiled once per model, then each batch is
+    converted column by column (the rows containing a None value,
+    before or after the conversion, are ignored)
+
+    Usage
+    =====
+    converter = MetricsConverter(['str', 'int'])
+    columns = converter.convert(rows)
+    '''
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        self.converters = [_compile_metric(m) for m in self.metrics]
+        self.prev_row = None
+
+    def convert(self, rows):
+        '''
+        Params
+        ======
+        - rows (list): Rows returned by the reader
+
+        Return
+        ======
+        A list of np.array (one per metric), numeric metrics are
+        converted to int64 / float64 arrays
+        '''
+        rows = list(rows)
+        columns = list(zip(*rows))[:len(self.metrics)]
+
+        # Ignore the rows with a missing value
+        valid = None
+        for column in columns:
+            if None in column:
+                mask = np.array([value is not None for value in column])
+                valid = mask if valid is None else valid & mask
+
+        if valid is not None:
+            rows = list(itertools.compress(rows, valid))
+            columns = list(zip(*rows))[:len(self.metrics)]
+
+        if not rows:
+            return [np.array([]) for _ in self.metrics]
+
+        prev_rows = [self.prev_row] + rows[:-1]
+        self.prev_row = rows[-1]
+
+        converted = []
+        valid = None
+        for converter, column in zip(self.converters, columns):
+            values, mask = converter(column, rows, prev_rows)
+            converted.append(values)
+
+            if mask is not None:
+                valid = ~mask if valid is None else valid & ~mask
+
+        if valid is not None:
+            converted = [values[valid] for values in converted]
+
+        return converted
+
+
+def _compile_metric(metric):
+    '''
+    Return a function converting a whole column
+
+    Use the vectorized version of the metric if it exists
+    (_<metric>_column), otherwise apply _<metric> on each value
+    '''
+    if metric.startswith('python_eval'):
+        return _python_eval_column(metric)
+
+    if ('_' + metric not in globals() or metric.startswith('_')
+            or metric.endswith('_column')):
+        raise ValueError('Wrong metric [%s]' % metric)
+
+    if '_%s_column' % metric in globals():
+        method = globals()['_%s_column' % metric]
+        return lambda column, rows, prev_rows: method(column)
+
+    method = globals()['_' + metric]
+    return lambda column, rows, prev_rows: _elementwise(method, column)
+
+
+def _elementwise(method, column):
+    return _to_array([method(value) for value in column])
+
+
+def _to_array(values):
+    '''
+    Return
+    ======
+    (np.array, mask of the None values or None)
     '''
-    if not hasattr(read_metrics, 'prev_row'):
-        read_metrics.prev_row = None
+    mask = None
+    if None in values:
+        mask = np.array([value is None for value in values])
+        values = [0 if value is None else value for value in values]
 
-    converted_values = []
-    for value, metric in zip(values, metrics):
-        if value is None:
-            return None
+    array = _numeric(values)
+    if array is None:
+        array = _object_array(values)
 
-        if metric.startswith('python_eval'):
-            value = _python_eval(values, read_metrics.prev_row, metric)
+    return array, mask
 
-        else:
-            if '_' + metric not in globals() or metric.startswith('_'):
-                raise ValueError('Wrong metric [%s]' % metric)
 
-            method = globals()['_' + metric]
-            value = method(value)
+def _numeric(values):
+    '''
+    Return a numeric np.array, or None if a value is not a number
+    '''
+    try:
+        array = np.array(values)
+    except (ValueError, OverflowError):
+        return None
 
-        converted_values.append(value)
+    if array.ndim != 1 or array.dtype.kind not in 'iufb':
+        return None
 
-    read_metrics.prev_row = values
+    return array
 
-    return converted_values
 
+def _object_array(values):
+    array = np.empty(len(values), dtype='object')
+    try:
+        array[:] = values
+    except ValueError:
+        # The values are sequences, numpy can not broadcast them
+        for i, value in enumerate(values):
+            array[i] = value
 
-def _python_eval(row, prev_row, metric):
+    return array
+
+
+def _python_eval_column(metric):
     # Todo: check if it's safe...
     python_code = metric[12:-1]
     python_code = python_code.replace('__', '')
-    return eval(python_code, {}, {'row': row, 'prev_row': prev_row})
+
+    # Models sharing an expression share its compiled version
+    if python_code not in _expressions:
+        _expressions[python_code] = _Expression(python_code)
+    expression = _expressions[python_code]
+
+    return lambda column, rows, prev_rows: expression.evaluate(
+        rows,
+        prev_rows
+    )
+
+
+_expressions = {}
+
+
+class _Expression:
+    '''
+    A python_eval expression, compiled once
+
+    The expression is first evaluated on whole columns (row[i] is
+    the column i, prev_row[i] the column i shifted by one row).
+    If it fails (condition on a value, string method...), it is
+    evaluated row by row for all the next batches
+    '''
+    def __init__(self, python_code):
+        self.code = compile(python_code, '<python_eval>', 'eval')
+        self.vectorized = True
+
+    def evaluate(self, rows, prev_rows):
+        if self.vectorized:
+            try:
+                return self._evaluate_columns(rows, prev_rows)
+            except Exception:
+                self.vectorized = False
+
+        return _to_array([
+            eval(self.code, {}, {'row': row, 'prev_row': prev_row})
+            for row, prev_row in zip(rows, prev_rows)
+        ])
+
+    def _evaluate_columns(self, rows, prev_rows):
+        # The first row of a model has no previous row
+        # (prev_row is None), evaluate it alone
+        head = []
+        if prev_rows[0] is None:
+            head = [eval(self.code, {}, {'row': rows[0], 'prev_row': None})]
+            rows = rows[1:]
+            prev_rows = prev_rows[1:]
+
+        if not rows:
+            return _to_array(head)
+
+        with np.errstate(all='raise'):
+            values = eval(self.code, {}, {
+                'row': _Columns(rows),
+                'prev_row': _Columns(prev_rows)
+            })
+
+        if (not isinstance(values, np.ndarray)
+                or values.shape != (len(rows),)
+                or values.dtype.kind not in 'iufb'):
+            raise TypeError('The expression can not be vectorized')
+
+        if not head:
+            return values, None
+
+        mask = None
+        if head[0] is None:
+            mask = np.zeros(len(rows) + 1, dtype=bool)
+            mask[0] = True
+            head = [0]
+
+        return np.concatenate([np.array(head), values]), mask
+
+
+class _Columns:
+    '''
+    Give access to the columns of a batch like to the values of a row
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+        self.columns = {}
+
+    def __getitem__(self, index):
+        if not isinstance(index, int):
+            raise TypeError('Only integer index can be vectorized')
+
+        if index not in self.columns:
+            values = [row[index] for row in self.rows]
+            array = _numeric(values)
+            self.columns[index] = (
+                _object_array(values) if array is None else array
+            )
+
+        return self.columns[index]
+
+    def __bool__(self):
+        # All the rows have a previous row (see _evaluate_columns)
+        return True
+
+
+def _str_column(column):
+    return _object_array(list(map(str, column))), None
+
+
+def _int_column(column):
+    array = _numeric(column)
+    if array is None:
+        return _elementwise(_int, column)
+
+    return array.astype(np.int64, copy=False), None
+
+
+def _float_column(column):
+    array = _numeric(column)
+    if array is None:
+        return _elementwise(_float, column)
+
+    return array.astype(np.float64, copy=False), None
+
+
+def _hour_column(column):
+    types = set(map(type, column))
+
+    if types == {int}:
+        timestamps = np.array(column, dtype=np.int64)
+
+    elif types == {float}:
+        # Timestamp in milliseconds
+        timestamps = (np.array(column) / 1000).astype(np.int64)
+
+    else:
+        return _elementwise(_hour, column)
+
+    return _local_hours(timestamps), None
+
+
+def _local_hours(timestamps):
+    '''
+    Vectorized datetime.fromtimestamp(timestamp).hour
+    '''
+    # The offset of the local timezone only changes on the hour
+    utc_hours, inverse = np.unique(timestamps // 3600, return_inverse=True)
+    offsets = np.array([
+        time.localtime(utc_hour * 3600).tm_gmtoff
+        for utc_hour in utc_hours.tolist()
+    ], dtype=np.int64)
+
+    local = timestamps + offsets[inverse.reshape(-1)]
+    local = local.astype('datetime64[s]')
+
+    return local.astype('datetime64[h]').astype(np.int64) % 24
 
 
 def _b64_encoded(value):
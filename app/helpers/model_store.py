@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import sklearn
+
+
+class ModelStore:
+    '''
+    Fitted estimators saved on disk, per model, per bucket and per batch
+    (the batch i of the next run is scored against the estimator of the
+    batch i, whatever the order in which the batches were processed)
+
+    A saved estimator is ignored (and refitted) if it's older than
+    refit_every seconds, if it was fitted during the current run, if the
+    detection settings changed, or if it was saved by another version of
+    the store or of scikit-learn
+
+    Params
+    ======
+    - directory (str): Directory of the store
+    '''
+    version = 2
+
+    def __init__(self, directory='../models'):
+        self.directory = directory
+
+    def load(self, model_name, bucket, i_batch, options, refit_every,
+             fitted_before=None):
+        '''
+        Params
+        ======
+        - fitted_before (float): The estimators fitted after this time
+                                 (start of the current run) are ignored
+
+        Return
+        ======
+        The fitted estimator, None if it must be fitted
+        '''
+        path = self._path(model_name, bucket, i_batch, options)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as stored:
+            stored = pickle.load(stored)
+
+        if (stored['version'] != self.version
+                or stored['sklearn_version'] != sklearn.__version__
+                or stored['options'] != _options_key(options)
+                or time.time() - stored['fitted_at'] > refit_every
+                or (fitted_before is not None
+                    and stored['fitted_at'] >= fitted_before)):
+            return None
+
+        return stored['estimator']
+
+    def save(self, model_name, bucket, i_batch, options, estimator):
+        path = self._path(model_name, bucket, i_batch, options)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        stored = {
+            'version': self.version,
+            'sklearn_version': sklearn.__version__,
+            'fitted_at': time.time(),
+            'bucket': bucket,
+            'batch': i_batch,
+            'options': _options_key(options),
+            'estimator': estimator
+        }
+
+        # Renamed once written, several processes can run the model
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as output:
+            pickle.dump(stored, output, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _path(self, model_name, bucket, i_batch, options):
+        '''
+        One file per bucket, per batch and per detection method of
+        the model
+        '''
+        model_name = hashlib.sha1(model_name.encode('utf-8')).hexdigest()
+        key = json.dumps([bucket, i_batch, _options_key(options)],
+                         default=str)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.directory, model_name, key + '.pickle')
+
+
+class StoredModel:
+    '''
+    Estimator of a (model, bucket, batch), given to the detectors
+
+    Params
+    ======
+    - store       (ModelStore): Store of the estimators
+    - model_name         (str): Name of the model
+    - bucket            (list): Value of the bucket
+    - i_batch            (int): Index of the batch in the bucket
+    - options           (dict): Detection settings of the model
+    - refit_every        (int): Maximum age of an estimator, in seconds
+    - run_time         (float): Start of the current run, only the
+                                estimators of the previous runs are used
+                                (the batches of a run are fitted on their
+                                own rows)
+    '''
+    def __init__(self, store, model_name, bucket, i_batch, options,
+                 refit_every, run_time=None):
+        self.store = store
+        self.model_name = model_name
+        self.bucket = bucket
+        self.i_batch = i_batch
+        self.options = options
+        self.refit_every = refit_every
+        self.run_time = run_time
+
+    def load(self):
+        return self.store.load(self.model_name, self.bucket, self.i_batch,
+                               self.options, self.refit_every,
+                               fitted_before=self.run_time)
+
+    def save(self, estimator):
+        self.store.save(self.model_name, self.bucket, self.i_batch,
+                        self.options, estimator)
+
+
+def _options_key(options):
+    '''
+    The settings which don't change the fitted estimator are ignored
+    '''
+    options = {
+        key: value for key, value in options.items()
+        if key not in ['sensitivity', 'trigger_on', 'refit_every',
+                       'model_store']
+    }
+
+    return json.dumps(options, sort_keys=True, default=str)
@@ -0,0 +1,373 @@
+import os
+import abc
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+from readers.es_writer import ESWriter
+from helpers import timing
+from helpers.utils import close_all
+from helpers.print_tools import print
+
+
+class ConsoleSink:
+    '''
+    Print the outliers, summarized: at most max_outliers outliers per
+    batch, and one batch per interval (the others are counted and
+    reported in the next print)
+
+    Params
+    ======
+    - max_outliers   (int): Outliers printed per batch, None for all
+    - interval     (float): Minimum number of seconds between two batches
+                            printed, 0 to print every batch
+    '''
+    def __init__(self, max_outliers=10, interval=1.):
+        self.max_outliers = max_outliers
+        self.interval = interval
+        self.last_print = None
+        self.skipped_batches = 0
+        self.skipped_outliers = 0
+
+    def add(self, summary, outliers):
+        '''
+        Params
+        ======
+        - summary   (dict): n_rows, n_outliers and methods (number of
+                            outliers per method or None) of the batch
+        - outliers  (list): Documents of the outliers (see
+                            outlier_document)
+        '''
+        now = time.time()
+        if (self.last_print is not None
+                and now - self.last_print < self.interval):
+            self.skipped_batches += 1
+            self.skipped_outliers += len(outliers)
+            return
+
+        self._print_skipped()
+        self.last_print = now
+
+        print('Number of elements: ', summary['n_rows'])
+        print('Number of outliers:', summary['n_outliers'])
+        print('Contamination: %.2f%%'
+              % (summary['n_outliers'] * 100 / summary['n_rows']))
+
+        if summary['methods'] is not None:
+            print('Outliers per method:', ' | '.join(
+                '%s: %i' % (name, n) for name, n in summary['methods'].items()
+            ))
+
+        shown = outliers
+        if self.max_outliers is not None:
+            shown = outliers[:self.max_outliers]
+
+        for outlier in shown:
+            print('    ', outlier['title'])
+            print('    ', outlier['message'])
+
+        if len(shown) < len(outliers):
+            print('     ... and %i other outliers'
+                  % (len(outliers) - len(shown)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._print_skipped()
+
+    def _print_skipped(self):
+        if self.skipped_batches:
+            print('%i outliers in %i batches not printed'
+                  % (self.skipped_outliers, self.skipped_batches))
+
+        self.skipped_batches = 0
+        self.skipped_outliers = 0
+
+
+class BufferedSink(abc.ABC):
+    '''
+    Write the outliers by batches of batch_size, or when the oldest
+    outlier waits for more than flush_interval seconds (checked when
+    outliers are added), the rest is written on close
+
+    The subclasses implement _write(outliers)
+
+    Params
+    ======
+    - batch_size       (int): Number of outliers written at once
+    - flush_interval (float): Maximum number of seconds an outlier waits
+    '''
+    def __init__(self, batch_size=1000, flush_interval=5.):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.first_added = None
+
+    def add(self, summary, outliers):
+        if not self.buffer:
+            self.first_added = time.time()
+        self.buffer.extend(outliers)
+
+        if (len(self.buffer) >= self.batch_size
+                or time.time() - self.first_added >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with timing.stage('output'):
+                self._write(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    @abc.abstractmethod
+    def _write(self, outliers):
+        '''
+        Params
+        ======
+        - outliers (list): Documents of the outliers (see outlier_document)
+        '''
+        pass
+
+
+class JsonlSink(BufferedSink):
+    '''
+    Append the outliers to a file, one json document per line
+
+    Params
+    ======
+    - path (str): Filename
+    '''
+    def __init__(self, path, batch_size=1000, flush_interval=5.):
+        super().__init__(batch_size, flush_interval)
+        self.path = path
+
+    def _write(self, outliers):
+        output = open(self.path, 'a')
+        output.write(''.join(
+            json.dumps(outlier) + '\n' for outlier in outliers
+        ))
+        output.close()
+
+
+class SQLiteSink(BufferedSink):
+    '''
+    Insert the outliers in the table "outliers" of a SQLite database
+    (model, run_time, bucket, batch, title, message, document)
+
+    Params
+    ======
+    - path (str): Filename of the database
+    '''
+    def __init__(self, path, batch_size=1000, flush_interval=5.):
+        super().__init__(batch_size, flush_interval)
+        self.path = path
+
+    def _write(self, outliers):
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            # Several models can write in the same database
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS outliers ('
+                'model TEXT, run_time REAL, bucket TEXT, batch INTEGER, '
+                'title TEXT, message TEXT, document TEXT)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS outliers_model '
+                'ON outliers (model, run_time)'
+            )
+
+            with connection:
+                connection.executemany(
+                    'INSERT INTO outliers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [
+                        (outlier['model'], outlier['run_time'],
+                         '-'.join(outlier['bucket']), outlier['batch'],
+                         outlier['title'], outlier['message'],
+                         json.dumps(outlier))
+                        for outlier in outliers
+                    ]
+                )
+
+        finally:
+            connection.close()
+
+
+class ESSink(BufferedSink):
+    '''
+    Index the outliers in Elasticsearch with an ESWriter (_bulk requests
+    sent in background, retried), the id of a document is derived from
+    the model, the bucket and the row (see outlier_id), so an outlier is
+    not indexed twice
+
+    Params
+    ======
+    - url            (str): Url of Elasticsearch
+    - index          (str): Index of the outliers
+    - doc_type       (str): Type of the documents (required by ES 6),
+                            None to omit it
+    - max_in_flight  (int): Maximum number of requests sent at once
+    - retries        (int): Number of retries of a request
+    - id_columns    (list): Columns of the row used for the id (a unique
+                            key of the rows), None for all the columns
+    '''
+    def __init__(self, url='http://127.0.0.1:9200', index='outliers',
+                 doc_type='_doc', batch_size=1000, flush_interval=5.,
+                 max_in_flight=2, retries=5, id_columns=None):
+        super().__init__(batch_size, flush_interval)
+        self.id_columns = id_columns
+        self.writer = ESWriter(url, index, doc_type, batch_size=batch_size,
+                               max_in_flight=max_in_flight, retries=retries)
+
+    def _write(self, outliers):
+        self.writer.write(outliers, [
+            outlier_id(outlier, self.id_columns) for outlier in outliers
+        ])
+        self.writer.flush()
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+SINKS = {
+    'console': ConsoleSink,
+    'jsonl': JsonlSink,
+    'sqlite': SQLiteSink,
+    'es': ESSink
+}
+
+# Outputs of the models without "outputs", the console only prints a
+# summary, all the outliers are written in the jsonl file
+DEFAULT_OUTPUTS = [{'type': 'console'}, {'type': 'jsonl'}]
+
+
+class OutlierSinks:
+    '''
+    Send the outliers to several sinks
+
+    Params
+    ======
+    - outputs    (list): Settings of the sinks (the "outputs" of the
+                         model), {'type': console, jsonl, sqlite or es,
+                         other parameters of the sink}
+    - directory   (str): Directory of the files of the model, the default
+                         path of the jsonl and sqlite sinks
+    '''
+    def __init__(self, outputs, directory):
+        self.sinks = []
+
+        for params in outputs:
+            params = dict(params)
+            sink_type = params.pop('type')
+            if sink_type not in SINKS:
+                raise Exception('Wrong output type [%s], accept: %s'
+                                % (sink_type, list(SINKS)))
+
+            if sink_type in ['jsonl', 'sqlite']:
+                params.setdefault(
+                    'path',
+                    os.path.join(directory, '_outliers.' + sink_type)
+                )
+
+            self.sinks.append(SINKS[sink_type](**params))
+
+    def add(self, summary, outliers):
+        for sink in self.sinks:
+            sink.add(summary, outliers)
+
+    def close(self):
+        '''
+        Close all the sinks, even if one fails (its error is raised)
+        '''
+        close_all([sink.close for sink in self.sinks])
+
+
+class CollectedOutliers:
+    '''
+    Outliers of a detection worker process, sent back with its logs
+    and added to the OutlierSinks of the analysis
+    '''
+    def __init__(self):
+        self.batches = []
+
+    def add(self, summary, outliers):
+        self.batches.append((summary, outliers))
+
+
+def outlier_document(settings, bucket, i_batch, row_index, title, message,
+                     row, methods=None):
+    '''
+    Return
+    ======
+    The document of an outlier written by the sinks: model, run_time,
+    bucket, batch, row_index (in the batch), title, message, methods
+    (if the model has several), the values of the targets and of the
+    row per column
+    '''
+    document = {
+        'model': settings['name'],
+        'run_time': settings['run_time'],
+        'bucket': [str(value) for value in bucket],
+        'batch': i_batch,
+        'row_index': row_index,
+        'title': title,
+        'message': message,
+        'targets': {
+            settings['columns'][target]: _json_value(row[target])
+            for target in settings['targets']
+        },
+        'row': {
+            column: _json_value(value)
+            for column, value in zip(settings['columns'], row)
+        }
+    }
+    if methods is not None:
+        document['methods'] = methods
+
+    return document
+
+
+def outlier_id(document, id_columns=None):
+    '''
+    Params
+    ======
+    - document    (dict): Document of the outlier (see outlier_document)
+    - id_columns  (list): Columns of the row used for the id,
+                          None for all the columns
+
+    Return
+    ======
+    Id of an outlier, derived from the model, the bucket and the values of
+    the row: the same whatever the run and the order of the rows (the
+    rows with the same values have the same id)
+    '''
+    row = document['row']
+    if id_columns is not None:
+        missing = [column for column in id_columns if column not in row]
+        if missing:
+            raise Exception('Wrong id columns %s, accept: %s'
+                            % (missing, list(row)))
+        row = {column: row[column] for column in id_columns}
+
+    key = json.dumps([document['model'], document['bucket'], row],
+                     sort_keys=True)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _json_value(value):
+    # numpy scalars (converted metrics)
+    if isinstance(value, np.generic):
+        value = value.item()
+
+    # NaN is not valid json
+    if isinstance(value, float) and value != value:
+        return None
+
+    return value
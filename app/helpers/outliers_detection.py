@@ -2,6 +2,9 @@ import numpy as np
 from sklearn.ensemble import IsolationForest
 from sklearn.neighbors import LocalOutlierFactor
 
+from helpers.lof import SortedLOF, SampledLOF
+from helpers.batch import BatchStats
+
 from helpers.utils import check_params
 from functools import wraps
 
@@ -15,7 +18,8 @@ def is_univariate(f):
             raise Exception('This method accept only 1D vector')
 
         if data.ndim == 2:
-            data = data.reshape(-1)
+            # View, no copy
+            args = (data.reshape(-1),) + args[1:]
 
         return f(*args, **kwargs)
 
@@ -25,84 +29,103 @@ def is_univariate(f):
 #####################
 # OUTLIER DETECTION #
 #####################
-def outlier_detection(data, options):
+def outlier_detection(data, options, model=None, stats=None):
+    '''
+    Params
+    ======
+    - data     (np.array): Targets of the batch
+    - options      (dict): Detection settings of the model
+    - model (StoredModel): Estimator of the bucket, used by the methods
+                           fitting an estimator (lof, lof_stdev,
+                           isolation_forest), None to always fit it
+    - stats  (BatchStats): Statistics of data, shared with other methods
+    '''
     if '_' + options['method'] not in globals():
         raise Exception('Wrong method')
     method = globals()['_' + options['method']]
 
     options = dict(options)
-    del options['method']
+    name = options.pop('method')
+    # Used by the analyzer (see streaming_detection, model_store)
+    for option in ['streaming', 'refit_every', 'model_store']:
+        options.pop(option, None)
+
+    if model is not None and name in FITTED_METHODS:
+        options['model'] = model
+
+    if stats is not None and name in STATS_METHODS:
+        options['stats'] = stats
 
     return method(data, **options)
 
 
-@is_univariate
-@check_params(trigger_on=['all', 'low', 'high'])
-def _stdev(data, sensitivity, trigger_on='all'):
-    if not data.std():
-        return np.array([])
+FITTED_METHODS = ['lof', 'lof_stdev', 'isolation_forest']
+STATS_METHODS = ['stdev', 'z_score', 'mad', 'pct_of_avg_value',
+                 'pct_of_max_value', 'pct_of_min_value',
+                 'pct_of_median_value', 'percentile']
+LOF_BACKENDS = ['sklearn', 'sorted', 'approximate']
 
-    scores = (data - np.median(data)) / data.std()
 
-    if trigger_on == 'low':
-        return np.where(- scores > sensitivity)[0]
+def _fitted(model, fit):
+    '''
+    Return the estimator of the model, fit and save it if needed
+    '''
+    if model is None:
+        return fit()
 
-    elif trigger_on == 'high':
-        return np.where(scores > sensitivity)[0]
+    estimator = model.load()
+    if estimator is None:
+        estimator = fit()
+        model.save(estimator)
 
-    return np.where(abs(scores) > sensitivity)[0]
+    return estimator
 
 
-@is_univariate
-@check_params(trigger_on=['all', 'low', 'high'])
-def _z_score(data, sensitivity, trigger_on='all'):
-    mad = np.median(abs(data - np.median(data)))
-    z_scores = (0.6745 * (data - np.median(data)) / mad)
+def _stats(data, stats):
+    '''
+    Return the shared statistics of data, or new ones
+    '''
+    if stats is None:
+        return BatchStats(data)
 
-    if trigger_on == 'low':
-        return np.where(z_scores < sensitivity)[0]
+    return stats
 
-    elif trigger_on == 'high':
-        return np.where(z_scores > sensitivity)[0]
 
-    return np.where(abs(z_scores) > sensitivity)[0]
+@is_univariate
+@check_params(trigger_on=['all', 'low', 'high'], stats=None)
+def _stdev(data, sensitivity, trigger_on='all', stats=None):
+    stats = _stats(data, stats)
+
+    return _score_stdev(data, stats.median, stats.std,
+                        sensitivity, trigger_on)
 
 
 @is_univariate
-@check_params(trigger_on=['all', 'low', 'high'])
-def _mad(data, sensitivity, trigger_on='all'):
-    mad = np.median(abs(data - np.median(data)))
-    if not mad:
-        return []
-    score = (data - np.median(data) / mad)
+@check_params(trigger_on=['all', 'low', 'high'], stats=None)
+def _z_score(data, sensitivity, trigger_on='all', stats=None):
+    stats = _stats(data, stats)
 
-    if trigger_on == 'low':
-        return np.where(- score > sensitivity)[0]
+    return _score_z_score(data, stats.median, stats.mad,
+                          sensitivity, trigger_on)
 
-    elif trigger_on == 'high':
-        return np.where(score > sensitivity)[0]
 
-    return np.where(abs(score) > sensitivity)[0]
+@is_univariate
+@check_params(trigger_on=['all', 'low', 'high'], stats=None)
+def _mad(data, sensitivity, trigger_on='all', stats=None):
+    stats = _stats(data, stats)
 
+    return _score_mad(data, stats.median, stats.mad, sensitivity, trigger_on)
 
-@check_params(trigger_on=['low', 'high'])
-def _lof(data, sensitivity, n_neighbors, trigger_on='low'):
 
-    if data.shape[0] <= n_neighbors:
+@check_params(trigger_on=['low', 'high'], backend=LOF_BACKENDS,
+              max_samples=None, model=None)
+def _lof(data, sensitivity, n_neighbors, trigger_on='low', backend='sklearn',
+         max_samples=10000, model=None):
+    lofs = _lof_scores(data, n_neighbors, backend, max_samples, model)
+    if lofs is None:
         # Not enough data to find outliers...
         return []
 
-    if data.ndim == 1:
-        data = data.reshape(-1, 1)
-
-    clf = LocalOutlierFactor(
-        novelty=True,
-        contamination=0.1,
-        n_neighbors=n_neighbors
-    )
-    clf.fit(data)
-    lofs = clf.score_samples(data)
-
     sensitivity /= 100
 
     index = np.argsort(lofs)
@@ -113,39 +136,93 @@ def _lof(data, sensitivity, n_neighbors, trigger_on='low'):
     return index[- int(len(index) * sensitivity):]
 
 
-@check_params(trigger_on=['low', 'high'])
-def _lof_stdev(data, sensitivity, n_neighbors, trigger_on='low'):
-    if data.shape[0] <= n_neighbors:
+@check_params(trigger_on=['low', 'high'], backend=LOF_BACKENDS,
+              max_samples=None, model=None)
+def _lof_stdev(data, sensitivity, n_neighbors, trigger_on='low',
+               backend='sklearn', max_samples=10000, model=None):
+    lofs = _lof_scores(data, n_neighbors, backend, max_samples, model)
+    if lofs is None:
         # Not enough data to find outliers...
         return []
 
+    return _stdev(lofs, sensitivity=sensitivity, trigger_on=trigger_on)
+
+
+def _lof_scores(data, n_neighbors, backend, max_samples, model=None):
+    '''
+    Return the LOF of each row, None if there is not enough
+    data to fit the estimator
+
+    Backends
+    ========
+    - sklearn:     LocalOutlierFactor (exact, KD-tree)
+    - sorted:      SortedLOF, exact for 1 target, O(n log n)
+    - approximate: SampledLOF, fitted on max_samples rows
+    '''
     if data.ndim == 1:
         data = data.reshape(-1, 1)
 
-    clf = LocalOutlierFactor(
-        novelty=True,
-        contamination=0.1,
-        n_neighbors=n_neighbors
-    )
-    clf.fit(data)
-    lofs = clf.score_samples(data)
+    if backend == 'sorted' and data.shape[1] > 1:
+        raise Exception('The sorted backend accept only 1D vector')
 
-    return _stdev(lofs, sensitivity=sensitivity, trigger_on=trigger_on)
+    def fit():
+        if backend == 'sorted':
+            clf = SortedLOF(n_neighbors)
+        elif backend == 'approximate':
+            clf = SampledLOF(n_neighbors, max_samples)
+        else:
+            clf = LocalOutlierFactor(
+                novelty=True,
+                contamination=0.1,
+                n_neighbors=n_neighbors
+            )
+        clf.fit(data)
+        return clf
+
+    estimator = model.load() if model is not None else None
+
+    if estimator is None and data.shape[0] <= n_neighbors:
+        return None
+
+    if estimator is None:
+        estimator = fit()
+        if model is not None:
+            model.save(estimator)
+
+    return estimator.score_samples(data)
 
 
 @is_univariate
-@check_params(trigger_on=['low', 'high'])
-def _isolation_forest(data, sensitivity, trigger_on='low'):
-    clf = IsolationForest(
-        behaviour='new',
-        max_samples=data.size,
-        contamination=0
-    )
-    clf.fit(data.reshape(-1, 1))
-    predictions = clf.predict(data.reshape(-1, 1))
+@check_params(trigger_on=['low', 'high'], max_samples=None,
+              n_estimators=None, n_jobs=None, chunk_size=None, model=None)
+def _isolation_forest(data, sensitivity, trigger_on='low', max_samples='auto',
+                      n_estimators=100, n_jobs=1, chunk_size=100000,
+                      model=None):
+    '''
+    Each tree is built on a sample of max_samples rows ('auto': 256),
+    the rows are scored by chunks of chunk_size rows to bound the memory
+    '''
+    data = data.reshape(-1, 1)
+
+    def fit():
+        clf = IsolationForest(
+            max_samples=max_samples,
+            n_estimators=n_estimators,
+            n_jobs=n_jobs,
+            # Not used, the rows are selected with the scores
+            contamination='auto',
+            random_state=0
+        )
+        clf.fit(data)
+        return clf
+
+    clf = _fitted(model, fit)
 
     # 1: high density -1: low density
-    predictions = clf.score_samples(data.reshape(-1, 1))
+    predictions = np.concatenate([
+        clf.score_samples(data[start:start + chunk_size])
+        for start in range(0, data.shape[0], chunk_size)
+    ])
     predictions += 1
 
     if trigger_on == 'low':
@@ -164,9 +241,9 @@ def _floats(data, sensitivity, trigger_on):
 
 
 @is_univariate
-@check_params(trigger_on=['low', 'high'])
-def _pct_of_avg_value(data, sensitivity, trigger_on):
-    avg = data.mean()
+@check_params(trigger_on=['low', 'high'], stats=None)
+def _pct_of_avg_value(data, sensitivity, trigger_on, stats=None):
+    avg = _stats(data, stats).mean
     pct = sensitivity / 100
 
     if trigger_on == 'low':
@@ -176,9 +253,9 @@ def _pct_of_avg_value(data, sensitivity, trigger_on):
 
 
 @is_univariate
-@check_params(trigger_on=['low', 'high'])
-def _pct_of_max_value(data, sensitivity, trigger_on):
-    avg = data.max()
+@check_params(trigger_on=['low', 'high'], stats=None)
+def _pct_of_max_value(data, sensitivity, trigger_on, stats=None):
+    avg = _stats(data, stats).max
     pct = sensitivity / 100
 
     if trigger_on == 'low':
@@ -188,9 +265,9 @@ def _pct_of_max_value(data, sensitivity, trigger_on):
 
 
 @is_univariate
-@check_params(trigger_on=['low', 'high'])
-def _pct_of_min_value(data, sensitivity, trigger_on):
-    avg = data.min()
+@check_params(trigger_on=['low', 'high'], stats=None)
+def _pct_of_min_value(data, sensitivity, trigger_on, stats=None):
+    avg = _stats(data, stats).min
     pct = sensitivity / 100
 
     if trigger_on == 'low':
@@ -200,9 +277,9 @@ def _pct_of_min_value(data, sensitivity, trigger_on):
 
 
 @is_univariate
-@check_params(trigger_on=['low', 'high'])
-def _pct_of_median_value(data, sensitivity, trigger_on):
-    avg = data.max()
+@check_params(trigger_on=['low', 'high'], stats=None)
+def _pct_of_median_value(data, sensitivity, trigger_on, stats=None):
+    avg = _stats(data, stats).max
     pct = sensitivity / 100
 
     if trigger_on == 'low':
@@ -212,16 +289,66 @@ def _pct_of_median_value(data, sensitivity, trigger_on):
 
 
 @is_univariate
-@check_params(trigger_on=['low', 'high'])
-def _percentile(data, sensitivity, trigger_on):
-    percentile = np.percentile(data, sensitivity)
-
-    if trigger_on == 'low':
-        return np.arange(data.shape[0])[data <= percentile]
+@check_params(trigger_on=['low', 'high'], stats=None)
+def _percentile(data, sensitivity, trigger_on, stats=None):
+    percentile = _stats(data, stats).percentile(sensitivity)
 
-    return np.arange(data.shape[0])[data >= percentile]
+    return _score_percentile(data, percentile, trigger_on)
 
 
 @check_params()
 def _trigger_all(data):
     return np.arange(data.shape[0])
+
+
+##########
+# SCORES #
+##########
+# The statistics are given, so they can come from
+# a whole batch or from a sketch (see streaming_detection)
+def _score_stdev(data, median, std, sensitivity, trigger_on):
+    if not std:
+        return np.array([])
+
+    scores = (data - median) / std
+
+    if trigger_on == 'low':
+        return np.where(- scores > sensitivity)[0]
+
+    elif trigger_on == 'high':
+        return np.where(scores > sensitivity)[0]
+
+    return np.where(abs(scores) > sensitivity)[0]
+
+
+def _score_z_score(data, median, mad, sensitivity, trigger_on):
+    z_scores = (0.6745 * (data - median) / mad)
+
+    if trigger_on == 'low':
+        return np.where(z_scores < sensitivity)[0]
+
+    elif trigger_on == 'high':
+        return np.where(z_scores > sensitivity)[0]
+
+    return np.where(abs(z_scores) > sensitivity)[0]
+
+
+def _score_mad(data, median, mad, sensitivity, trigger_on):
+    if not mad:
+        return []
+    score = (data - median / mad)
+
+    if trigger_on == 'low':
+        return np.where(- score > sensitivity)[0]
+
+    elif trigger_on == 'high':
+        return np.where(score > sensitivity)[0]
+
+    return np.where(abs(score) > sensitivity)[0]
+
+
+def _score_percentile(data, percentile, trigger_on):
+    if trigger_on == 'low':
+        return np.arange(data.shape[0])[data <= percentile]
+
+    return np.arange(data.shape[0])[data >= percentile]
@@ -0,0 +1,210 @@
+import os
+import json
+import sqlite3
+from contextlib import contextmanager
+
+
+class PlotIndex:
+    '''
+    Metadata of the plots of a model, in a SQLite database next to the
+    plots (_index.sqlite), so the web viewer filters and pages them
+    without reading every json file
+
+    The connection is opened (and the table created) once, the plots
+    are added by buffer_size in one transaction. Several processes can
+    add plots at the same time (the writers wait for the lock), and the
+    database can be read while it's written
+
+    Params
+    ======
+    - directory    (str): Directory of the plots of the model
+    - buffer_size  (int): Number of plots written at once
+
+    Usage
+    =====
+    with PlotIndex(directory) as index:
+        index.add(metadata)
+    '''
+    filename = '_index.sqlite'
+    sort_columns = ['name', 'n_outliers']
+
+    def __init__(self, directory, buffer_size=100):
+        self.directory = directory
+        self.path = os.path.join(directory, self.filename)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def add(self, metadata):
+        '''
+        Params
+        ======
+        - metadata (dict): Metadata of a plot (see plotter.histogram),
+                           replace the plot with the same name
+        '''
+        self.buffer.append(metadata)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the plots of the buffer
+        '''
+        if not self.buffer:
+            return
+
+        with self._transaction() as connection:
+            self._insert(connection, self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def search(self, page_size, page_number, hide_no_outlier=False,
+               hide_one_col=False, search='', sort='name'):
+        '''
+        Return
+        ======
+        (number of plots matching the filters, list of the metadata
+        of the plots of the page)
+        '''
+        if sort not in self.sort_columns:
+            raise ValueError('Wrong sort column [%s]' % sort)
+
+        conditions = []
+        params = []
+        if hide_no_outlier:
+            conditions.append('n_outliers > 0')
+        if hide_one_col:
+            conditions.append('one_col = 0')
+        if search:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append('%' + _escape_like(search) + '%')
+
+        where = ''
+        if conditions:
+            where = 'WHERE ' + ' AND '.join(conditions)
+
+        order = 'name' if sort == 'name' else sort + ' DESC, name'
+
+        with self._transaction() as connection:
+            total = connection.execute(
+                'SELECT COUNT(*) FROM plots ' + where, params
+            ).fetchone()[0]
+
+            rows = connection.execute(
+                'SELECT metadata FROM plots %s ORDER BY %s LIMIT ? OFFSET ?'
+                % (where, order),
+                params + [page_size, page_number * page_size]
+            ).fetchall()
+
+        return total, [json.loads(metadata) for metadata, in rows]
+
+    def summary(self):
+        '''
+        Return
+        ======
+        (number of plots, total number of outliers)
+        '''
+        with self._transaction() as connection:
+            n_plots, n_outliers = connection.execute(
+                'SELECT COUNT(*), SUM(n_outliers) FROM plots'
+            ).fetchone()
+
+        return n_plots, n_outliers or 0
+
+    def rebuild(self):
+        '''
+        Index the json files of the plots (directories of the
+        plots made before the index existed)
+        '''
+        plots = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') and not name.startswith('_'):
+                plots.append(json.load(
+                    open(os.path.join(self.directory, name))))
+
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM plots')
+            self._insert(connection, plots)
+
+    @contextmanager
+    def _transaction(self):
+        '''
+        Connection in a transaction (committed at the end of the block)
+        '''
+        with self._connect() as connection:
+            yield connection
+
+    def _connect(self):
+        '''
+        Open the connection and create the table, the first time
+        '''
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=60)
+            # The readers don't block the writers
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS plots ('
+                'name TEXT PRIMARY KEY, n_outliers INTEGER, '
+                'one_col INTEGER, aggregation TEXT, metadata TEXT)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS plots_n_outliers '
+                'ON plots (n_outliers)'
+            )
+            connection.commit()
+            self.connection = connection
+
+        return self.connection
+
+    @staticmethod
+    def _insert(connection, plots):
+        # The histogram data is read from the json file of the plot
+        # when it's drawn, the pages only need the metadata
+        connection.executemany(
+            'INSERT OR REPLACE INTO plots VALUES (?, ?, ?, ?, ?)',
+            [
+                (plot['name'], plot['n_outliers'], plot['one_col'],
+                 plot['aggregation'], json.dumps({
+                     key: value for key, value in plot.items()
+                     if key != 'histogram'
+                 }))
+                for plot in plots
+            ]
+        )
+
+
+class CollectedPlots:
+    '''
+    Metadata of the plots of a detection worker process, sent back with
+    its logs and added to the PlotIndex of the analysis
+    '''
+    def __init__(self):
+        self.plots = []
+
+    def add(self, metadata):
+        # The histogram data is not indexed
+        self.plots.append({
+            key: value for key, value in metadata.items()
+            if key != 'histogram'
+        })
+
+
+def _escape_like(text):
+    for char in ['\\', '%', '_']:
+        text = text.replace(char, '\\' + char)
+
+    return text
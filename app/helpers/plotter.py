@@ -5,6 +5,8 @@ import numpy as np
 import matplotlib; matplotlib.use('agg')
 import matplotlib.pyplot as plt
 
+from helpers.plot_index import PlotIndex
+
 
 matplotlib.style.use('seaborn-white')
 
@@ -12,76 +14,218 @@ colors = ['#34495e', '#e74c3c', '#2ecc71', '#95a5a6', '#3498db', '#9b59b6']
 title_size = 19
 legend_size = 13
 axis_label_size = 17
+png_dpi = 100
 
 
 def histogram(data, outliers, labels, title='Histogram', xlabel='Value',
-              ylabel='Count', bins=40, log=True, filename=None, show=False):
-
+              ylabel='Count', bins=40, log=True, filename=None, show=False,
+              groups=None, render=True, format='svg', renderer=None,
+              index=None):
+    '''
+    groups: list of (label, index), the outliers of each detection method
+            are drawn together instead of the outliers
+    render: if False, only the histogram data is saved (in the json file),
+            the plot is drawn by the web viewer when it's opened (see draw)
+    format: svg or png (faster, at png_dpi)
+    renderer: RenderPool (or RenderJobs) drawing the plot in background,
+              it's drawn in this process if None
+    index: PlotIndex (or CollectedPlots) of the plots of the model, the
+           plot is added to the index of its directory if None
+    '''
     data = np.array(data).reshape(-1)
-    std = data.std()
     outliers = np.array(outliers).astype(int)
 
-    if len(outliers):
-        data = [
-            np.delete(data, outliers),
-            data[outliers]
-        ]
-    else:
-        data = [data]
-        labels = [labels[0]]
-
-    fig = plt.figure()
-    fig.patch.set_alpha(0)
-
-    if std < 0.000001:
-        plt.ylim(bottom=0.7)
-
-    plt.hist(
-        data,
-        color=colors[:len(data)],
-        label=labels,
-        bins=bins,
-        density=False
-    )
-
-    plt.title(title, fontsize=title_size)
-
-    xlabel = ' '.join(xlabel.split('_')).capitalize()
-
-    plt.ylabel(ylabel, fontsize=axis_label_size)
-    plt.xlabel(xlabel, fontsize=axis_label_size)
-
-    if log:
-        plt.yscale('log')
-
-    plt.ylabel('Count', fontsize=axis_label_size)
-    plt.legend(fontsize=legend_size)
-
-    plt.gca().patch.set_alpha(0)
-    plt.gca().spines['top'].set_visible(False)
-    plt.gca().spines['right'].set_visible(False)
-    plt.gca().spines['bottom'].set_visible(False)
-    plt.gca().spines['left'].set_visible(False)
-
-    if show:
-        plt.show()
+    hist = histogram_data(data, outliers, labels, bins, groups)
+    hist.update(title=title, xlabel=xlabel, ylabel=ylabel, log=log)
 
     if filename is not None:
         path = '/'.join(filename.split('/')[:-1])
-        if not os.path.exists(path):
-            os.mkdir(path)
+        os.makedirs(path, exist_ok=True)
 
-        plt.savefig(filename + '.svg', transparent=True, edgecolor='none')
+    if show:
+        draw(hist, show=True)
 
+    if filename is not None and render:
+        if renderer is not None:
+            renderer.submit(hist, filename + '.' + format)
+        else:
+            draw(hist, filename=filename + '.' + format)
+
+    if filename is not None:
         metadata = {
             'name': filename.split('/')[-1],
             'n_outliers': len(outliers),
-            'one_col': int(std < 0.0000001),
+            'one_col': int(hist['std'] < 0.0000001),
             'aggregation': filename.split('/')[-1].split('[')[0]
         }
+        if groups is not None:
+            metadata['methods'] = {
+                label: len(index) for label, index in groups
+            }
+        metadata['format'] = format
+        metadata['histogram'] = hist
 
         output = open(filename + '.json', 'w')
         output.write(json.dumps(metadata))
         output.close()
 
-    plt.close()
+        # Used by the web viewer
+        if index is not None:
+            index.add(metadata)
+        else:
+            with PlotIndex(path) as index:
+                index.add(metadata)
+
+
+def histogram_data(data, outliers, labels, bins=40, groups=None):
+    '''
+    Count the values of each layer of the histogram (the data, and the
+    outliers or the outliers of each method) in the same bins
+
+    Return
+    ======
+    {'edges': bin edges, 'counts': list of counts per layer,
+     'labels': label of each layer, 'std': standard deviation of the data}
+    '''
+    std = data.std()
+
+    if groups is not None:
+        found = [np.array(index).astype(int) for _, index in groups]
+        layers = [np.delete(data, np.unique(np.concatenate(found)))] + [
+            data[index] for index in found
+        ]
+        labels = [labels[0]] + [label for label, _ in groups]
+
+    elif len(outliers):
+        layers = [
+            np.delete(data, outliers),
+            data[outliers]
+        ]
+    else:
+        layers = [data]
+        labels = [labels[0]]
+
+    # Same bins as plt.hist on all the layers
+    edges = np.histogram_bin_edges(data, bins)
+
+    return {
+        'edges': edges.tolist(),
+        'counts': [np.histogram(layer, edges)[0].tolist() for layer in layers],
+        'labels': list(labels),
+        'std': float(std)
+    }
+
+
+def draw(hist, filename=None, show=False):
+    '''
+    Draw a histogram saved by histogram / histogram_data, on the figure
+    reused by the process (on a new one to show it)
+
+    Params
+    ======
+    - hist      (dict): Histogram data, with its title, xlabel, ylabel
+                        and log
+    - filename   (str): SVG or PNG file, not saved if None
+    - show      (bool): Show the plot
+    '''
+    if show:
+        figure = HistogramFigure()
+    else:
+        if draw.figure is None:
+            draw.figure = HistogramFigure()
+        figure = draw.figure
+
+    figure.draw(hist)
+
+    if show:
+        plt.show()
+
+    if filename is not None:
+        figure.save(filename)
+
+    if show:
+        figure.close()
+
+
+draw.figure = None
+
+
+class HistogramFigure:
+    '''
+    Figure drawing the histograms, created once and reused: only the bars,
+    the legend, the title and the labels are replaced between two plots
+    '''
+    def __init__(self):
+        self.figure = plt.figure()
+        self.figure.patch.set_alpha(0)
+
+        self.axes = self.figure.gca()
+        self.axes.patch.set_alpha(0)
+        for spine in self.axes.spines.values():
+            spine.set_visible(False)
+
+        self.bars = []
+
+    def draw(self, hist):
+        axes = self.axes
+        edges = np.array(hist['edges'])
+        counts = hist['counts']
+
+        for bars in self.bars:
+            bars.remove()
+
+        # Limits of a new figure
+        axes.set_yscale('linear')
+        axes.set_xlim(0, 1)
+        axes.set_ylim(0, 1)
+        axes.set_autoscale_on(True)
+
+        if hist['std'] < 0.000001:
+            axes.set_ylim(bottom=0.7)
+
+        # One value per bin, weighted by its count
+        _, _, self.bars = axes.hist(
+            [edges[:-1]] * len(counts),
+            weights=counts,
+            color=[colors[i % len(colors)] for i in range(len(counts))],
+            label=hist['labels'],
+            bins=edges,
+            density=False
+        )
+        if len(counts) == 1:
+            self.bars = [self.bars]
+
+        # Limits of the new bars only
+        axes.relim()
+
+        axes.set_title(hist['title'], fontsize=title_size)
+
+        xlabel = ' '.join(hist['xlabel'].split('_')).capitalize()
+
+        axes.set_ylabel(hist['ylabel'], fontsize=axis_label_size)
+        axes.set_xlabel(xlabel, fontsize=axis_label_size)
+
+        if hist['log']:
+            axes.set_yscale('log')
+
+        axes.legend(fontsize=legend_size)
+
+    def save(self, filename):
+        '''
+        Save the figure (SVG or PNG, from the extension of filename),
+        the file is replaced at once, it can be read while it's saved
+        '''
+        image_format = filename.split('.')[-1]
+        tmp_filename = '%s.%i.tmp' % (filename, os.getpid())
+
+        self.figure.savefig(
+            tmp_filename,
+            format=image_format,
+            dpi=png_dpi if image_format == 'png' else None,
+            transparent=True,
+            edgecolor='none'
+        )
+        os.replace(tmp_filename, filename)
+
+    def close(self):
+        plt.close(self.figure)
@@ -1,5 +1,6 @@
 import sys
 import math
+import time
 
 
 def print(*data, type='info'):
@@ -33,59 +34,175 @@ def print(*data, type='info'):
         + ' '.join([('\n' + p).join(str(d).split('\n')) for d in data])
     )
 
-    if hasattr(print_progress, 'output') and print_progress.output:
-        sys.stdout.write('\b' * len(print_progress.output))
+    if Progress.output:
+        sys.stdout.write('\b' * len(Progress.output))
         sys.stdout.write(output)
-        sys.stdout.write(' ' * max(0, len(print_progress.output)-len(output)))
+        sys.stdout.write(' ' * max(0, len(Progress.output) - len(output)))
         sys.stdout.write('\n')
-        sys.stdout.write(print_progress.output)
+        sys.stdout.write(Progress.output)
 
     else:
         sys.stdout.write(output + '\n')
 
 
-def print_progress(iteration, total, prefix=''):
-    if not hasattr(print_progress, 'last_prog'):
-        print_progress.last_prog = -1
+class Progress:
+    '''
+    Progress of a loop, cheap enough to be updated for each row
+
+    The clock is only read every 'every' rows, and the progress is
+    written at most every 'interval' seconds. When the output is not a
+    terminal, a log line is printed every 'log_interval' seconds instead
+    of the progress bar
+
+    Params
+    ======
+    - total          (int): Total number of rows, None if unknown
+    - prefix         (str): Text written before the progress
+    - unit           (str): Name of the counted items
+    - every          (int): Number of rows between two checks of the clock
+    - interval     (float): Seconds between two updates of the progress bar
+    - log_interval (float): Seconds between two log lines (not a terminal)
+
+    Usage
+    =====
+    progress = Progress(n_rows)
+    for row in rows:
+        progress.update()
+    progress.end()
+
+    Set Progress.disabled (see disable_progress) to hide the progress
+    '''
+    disabled = False
+    # Progress line written on the terminal
+    output = ''
+
+    def __init__(self, total=None, prefix='', unit='rows', every=1000,
+                 interval=0.1, log_interval=10):
+        self.total = total
+        self.prefix = prefix
+        self.unit = unit
+        self.every = every
+        self.interval = interval if sys.stdout.isatty() else log_interval
+        self.tty = sys.stdout.isatty()
+
+        self.count = 0
+        self.start = time.time()
+        self._next_check = every
+        self._last_write = self.start
+        self._step = 0
+
+    def update(self, n=1):
+        self.count += n
+        if self.count < self._next_check:
+            return
+        self._next_check = self.count + self.every
+
+        now = time.time()
+        if Progress.disabled or now - self._last_write < self.interval:
+            return
+        self._last_write = now
+
+        text = '%s %s' % (self.prefix, self._status(now))
+        if self.tty:
+            self._step += 1
+            _write_progress(self._step, text + ' ')
+        else:
+            print(text)
+
+    def end(self):
+        '''
+        Terminate the progress line, and print the speed
+        '''
+        end_progress()
+
+        elapsed = time.time() - self.start
+        print('%i %s in %s (%i %s/s)' % (
+            self.count, self.unit, _duration(elapsed),
+            self.count / elapsed if elapsed else 0, self.unit
+        ))
+
+    def _status(self, now):
+        elapsed = now - self.start
+        speed = self.count / elapsed if elapsed else 0
+
+        if self.total is None or self.count > self.total:
+            # The reader can not count the rows (or the count
+            # was an estimate), show a counter
+            return '%i %s | %i %s/s' % (self.count, self.unit,
+                                        speed, self.unit)
+
+        length = 50
+        filled = int(length * self.count // max(self.total, 1))
+        bar = '#' * filled + '.' * (length - filled)
+        eta = (self.total - self.count) / speed if speed else 0
+
+        return '[%s] %.2f%% | %i %s/s | ETA %s' % (
+            bar, self.count * 100 / max(self.total, 1),
+            speed, self.unit, _duration(eta)
+        )
+
+
+def disable_progress():
+    '''
+    Hide the progress bar (used in the worker processes)
+    '''
+    Progress.disabled = True
+    Progress.output = ''
+
+
+def print_logs(logs):
+    '''
+    Write the logs captured in a worker process, above the progress bar
+    '''
+    output = Progress.output
+    if output:
+        sys.stdout.write('\b' * len(output))
+        sys.stdout.write(' ' * len(output))
+        sys.stdout.write('\b' * len(output))
+
+    sys.stdout.write(logs)
+
+    if output:
+        sys.stdout.write(output)
+    sys.stdout.flush()
 
-    iteration += 1
-    prog = iteration * 100 / total
 
-    if prog - print_progress.last_prog < 0.01 and iteration != total:
-        return
+def end_progress():
+    '''
+    Terminate the current progress line
+    '''
+    if Progress.output:
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+    Progress.output = ''
 
-    print_progress.last_prog = prog
 
+def _write_progress(step, text):
     sym = ['-', '\\', '|', '/', '-', '\\', '|', '/']
-
-    decimals = 1
-    fill = '#'  # '█'
-    length = 50
     color = '\033[34m'
     ENDC = '\033[0m'
 
-    percent = '{0:.2f}'.format(prog)
-
-    filledLength = int(length * iteration // total)
-    bar = fill * filledLength + '.' * (length - filledLength)
+    sys.stdout.write('\b' * len(Progress.output))
 
-    if hasattr(print_progress, 'output'):
-        sys.stdout.write('\b' * len(print_progress.output))
-
-    print_progress.output = '%s[%s]%s %s [%s] %s%% ' % (
+    output = '%s[%s]%s %s' % (
         color,
-        sym[int(prog / 10) % len(sym)],
+        sym[int(step) % len(sym)],
         ENDC,
-        prefix,
-        bar,
-        percent
+        text
     )
-    sys.stdout.write(print_progress.output)
+    # Erase the end of the previous line
+    sys.stdout.write(output + ' ' * max(0, len(Progress.output) - len(output)))
+    if len(Progress.output) > len(output):
+        sys.stdout.write('\b' * (len(Progress.output) - len(output)))
+
+    Progress.output = output
     sys.stdout.flush()
 
-    if iteration >= total:
-        sys.stdout.write('\n')
-        print_progress.output = ''
+
+def _duration(seconds):
+    seconds = int(seconds)
+
+    return '%i:%02i:%02i' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
 
 
 def intro_message():
@@ -0,0 +1,224 @@
+import re
+import json
+
+from helpers.sql_parser import top_level_matches, split_top_level, \
+    normalize
+
+
+def plan(jobs):
+    '''
+    Group the models running the same query
+
+    Two models share their query if they use the same reader, and their
+    queries are identical once the ORDER BY and the aliases of the
+    selected columns are removed (the aliases are kept when the query
+    refers to them, in its WHERE, GROUP BY or HAVING). The shared query is
+    run once, the columns are mapped by position, and each model sorts the
+    rows locally (see MemoryReader)
+
+    Params
+    ======
+    - jobs (list): List of (reader parameters, model settings)
+
+    Return
+    ======
+    A list of (reader parameters, shared query or None, list of models)
+    '''
+    groups = {}
+    units = []
+
+    for reader_params, model in jobs:
+        if not is_shareable(model['sql_query']):
+            units.append((reader_params, None, [model]))
+            continue
+
+        base_query = split_order_by(model['sql_query'])[0]
+        if not _references_aliases(base_query):
+            base_query = _strip_aliases(base_query)
+
+        key = json.dumps([reader_params, base_query], sort_keys=True)
+        if key not in groups:
+            groups[key] = (reader_params, base_query, [])
+            units.append(groups[key])
+
+        groups[key][2].append(model)
+
+    # A query used by only one model is sent as it is
+    return [
+        (reader_params, None, models) if len(models) == 1
+        else (reader_params, base_query, models)
+        for reader_params, base_query, models in units
+    ]
+
+
+def split_order_by(sql_query):
+    '''
+    Return
+    ======
+    (normalized query without the ORDER BY, ORDER BY clause or '')
+    '''
+    sql_query = normalize(sql_query)
+    matches = top_level_matches(r'\bORDER BY\b', sql_query)
+
+    if len(matches) != 1:
+        return sql_query, ''
+
+    return (sql_query[:matches[0].start()].strip(),
+            sql_query[matches[0].end():].strip())
+
+
+def is_shareable(sql_query):
+    '''
+    The ORDER BY must be done on selected columns (to sort the rows
+    locally), and must not be followed by a LIMIT
+    '''
+    if top_level_matches(r'\bLIMIT\b', sql_query):
+        return False
+
+    if _select_items(sql_query) is None:
+        return False
+
+    return order_by_columns(sql_query) is not None
+
+
+def select_aliases(sql_query):
+    '''
+    Return
+    ======
+    The alias of each selected column (None if it has no alias)
+    '''
+    return [
+        parts[1] if len(parts) > 1 else None
+        for parts in _select_items(sql_query)
+    ]
+
+
+def order_by_columns(sql_query):
+    '''
+    Return
+    ======
+    A list of (column index, descending) for each ORDER BY item,
+    or None if an item is not a selected column
+    '''
+    _, order_by = split_order_by(sql_query)
+    if not order_by:
+        return []
+
+    columns = _select_columns(sql_query)
+    if columns is None:
+        return None
+
+    order = []
+    for item in split_top_level(order_by):
+        match = re.match(r'^(.*?)(?:\s+(ASC|DESC))?$', item, re.IGNORECASE)
+        expression = _normalize_expression(match.group(1))
+        descending = (match.group(2) or '').upper() == 'DESC'
+
+        index = [
+            i for i, names in enumerate(columns) if expression in names
+        ]
+        if not index:
+            return None
+
+        order.append((index[0], descending))
+
+    return order
+
+
+def _select_columns(sql_query):
+    '''
+    Return
+    ======
+    For each selected column, the set of names referring to it
+    (expression and alias), or None if the query can not be parsed
+    '''
+    items = _select_items(sql_query)
+    if items is None:
+        return None
+
+    return [{_normalize_expression(p) for p in parts} for parts in items]
+
+
+def _select_items(sql_query):
+    '''
+    Return
+    ======
+    For each selected column [expression] or [expression, alias],
+    None if the query can not be parsed
+    '''
+    parts = _select_parts(sql_query)
+    if parts is None or parts[1].strip() == '*':
+        return None
+
+    items = []
+    for item in split_top_level(parts[1]):
+        # The alias follows the last AS outside the parenthesis and the
+        # quotes, CAST(t AS FLOAT) AS time
+        matches = top_level_matches(r'\s+AS\s+', item)
+        if matches:
+            items.append([item[:matches[-1].start()],
+                          item[matches[-1].end():]])
+        else:
+            items.append([item])
+
+    return items
+
+
+def _select_parts(sql_query):
+    '''
+    Return
+    ======
+    (SELECT keyword, selected columns, FROM and the next clauses) of the
+    normalized query, None if the query can not be parsed
+    '''
+    sql_query = normalize(sql_query)
+    select = re.match(r'^SELECT\s+', sql_query, re.IGNORECASE)
+    froms = top_level_matches(r'\sFROM\b', sql_query)
+
+    if select is None or not froms:
+        return None
+
+    start = select.end()
+    end = froms[0].start()
+
+    return sql_query[:start], sql_query[start:end], sql_query[end:]
+
+
+def _strip_aliases(sql_query):
+    '''
+    Remove the aliases of the selected columns
+    '''
+    parts = _select_parts(sql_query)
+    expressions = [items[0] for items in _select_items(sql_query)]
+
+    return parts[0] + ', '.join(expressions) + parts[2]
+
+
+def _references_aliases(sql_query):
+    '''
+    True if the clauses after the FROM (WHERE, GROUP BY, HAVING...) use an
+    alias of the selected columns, for example:
+    SELECT name, COUNT(*) AS occurs FROM t GROUP BY name HAVING occurs < 5
+    '''
+    clauses = _select_parts(sql_query)[2]
+
+    for items in _select_items(sql_query):
+        if len(items) < 2:
+            continue
+
+        alias = items[1]
+        if alias[:1] in '\'"`':
+            # Quoted alias, the quotes are masked by top_level_matches
+            if alias in clauses:
+                return True
+
+        elif top_level_matches(r'(?<![\w.])%s(?![\w(])' % re.escape(alias),
+                               clauses, parenthesis=False):
+            return True
+
+    return False
+
+
+def _normalize_expression(expression):
+    return re.sub(r'\s+', '', expression).lower()
+
@@ -0,0 +1,80 @@
+import multiprocessing
+
+from helpers import plotter
+from helpers.print_tools import print
+
+
+class RenderPool:
+    '''
+    Processes drawing the plots (see plotter.draw) from a queue, so the
+    analysis doesn't wait for matplotlib, each process reuses its figure
+
+    Params
+    ======
+    - workers      (int): Number of processes
+    - queue_size   (int): Maximum number of plots waiting in the queue,
+                          submit waits when it's full
+
+    Usage
+    =====
+    renderer = RenderPool(2)
+    plotter.histogram(..., renderer=renderer)
+    renderer.close()
+    '''
+    def __init__(self, workers=1, queue_size=1000):
+        self.queue = multiprocessing.Queue(queue_size)
+        self.processes = [
+            multiprocessing.Process(
+                target=_render_worker,
+                args=(self.queue,),
+                daemon=True
+            )
+            for _ in range(workers)
+        ]
+
+        for process in self.processes:
+            process.start()
+
+    def submit(self, hist, filename):
+        '''
+        Params
+        ======
+        - hist      (dict): Histogram data (see plotter.histogram)
+        - filename   (str): SVG or PNG file
+        '''
+        self.queue.put((hist, filename))
+
+    def close(self):
+        '''
+        Wait for the plots of the queue, and stop the processes
+        '''
+        for _ in self.processes:
+            self.queue.put(None)
+
+        for process in self.processes:
+            process.join()
+
+
+class RenderJobs:
+    '''
+    Plots of a detection worker process, sent back with its logs and
+    submitted to the RenderPool of the analysis
+    '''
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, hist, filename):
+        self.jobs.append((hist, filename))
+
+
+def _render_worker(queue):
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+
+        hist, filename = job
+        try:
+            plotter.draw(hist, filename=filename)
+        except Exception as e:
+            print('Plot [%s] not drawn: %s' % (filename, e), type='error')
@@ -0,0 +1,83 @@
+import re
+
+
+def top_level_mask(text, parenthesis=True):
+    '''
+    Return
+    ======
+    For each character of the query, True if it is outside the string
+    literals ('...'), the quoted names ("...", `...`) and the parenthesis
+    (only outside the quotes if parenthesis is False)
+    '''
+    mask = []
+    depth = 0
+    quote = None
+    for char in text:
+        if quote is not None:
+            mask.append(False)
+            # A doubled quote ('') closes and reopens the literal
+            if char == quote:
+                quote = None
+
+        elif char in '\'"`':
+            mask.append(False)
+            quote = char
+
+        elif char == '(' and parenthesis:
+            mask.append(False)
+            depth += 1
+
+        elif char == ')' and parenthesis:
+            mask.append(False)
+            depth -= 1
+
+        else:
+            mask.append(not depth)
+
+    return mask
+
+
+def top_level_matches(pattern, text, flags=re.IGNORECASE,
+                      parenthesis=True):
+    '''
+    Return
+    ======
+    The matches of the pattern starting outside the quotes and the
+    parenthesis (see top_level_mask)
+    '''
+    mask = top_level_mask(text, parenthesis)
+
+    return [
+        match for match in re.finditer(pattern, text, flags)
+        if mask[match.start()]
+    ]
+
+
+def split_top_level(text, pattern=','):
+    '''
+    Split on the separators which are outside the quotes and the
+    parenthesis, the items are stripped
+    '''
+    items = []
+    start = 0
+    for match in top_level_matches(pattern, text):
+        items.append(text[start:match.start()].strip())
+        start = match.end()
+
+    items.append(text[start:].strip())
+
+    return items
+
+
+def normalize(sql_query):
+    '''
+    Replace the spaces between the words by one space (the string
+    literals are kept)
+    '''
+    mask = top_level_mask(sql_query, parenthesis=False)
+
+    return re.sub(
+        r'\s+',
+        lambda match: ' ' if mask[match.start()] else match.group(),
+        sql_query
+    ).strip()
@@ -0,0 +1,195 @@
+import math
+import numpy as np
+
+from helpers import outliers_detection
+
+
+class Moments:
+    '''
+    Mean and variance updated batch by batch
+    (Welford / Chan et al. parallel algorithm)
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, data):
+        if not data.size:
+            return
+
+        count = data.size
+        mean = data.mean()
+        m2 = ((data - mean) ** 2).sum()
+
+        delta = mean - self.mean
+        total = self.count + count
+
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        '''
+        Population standard deviation, like np.std
+        '''
+        if not self.count:
+            return 0.
+
+        return math.sqrt(self.m2 / self.count)
+
+
+class TDigest:
+    '''
+    Approximate quantiles with a bounded number of centroids
+    (merging t-digest, the batches are merged at once)
+
+    Params
+    ======
+    - compression (int): About the maximum number of centroids,
+                         the bigger the more accurate
+    '''
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.array([])
+        self.weights = np.array([])
+
+    def update(self, data, weights=None):
+        if not data.size:
+            return
+
+        if weights is None:
+            weights = np.ones(data.size)
+
+        means = np.concatenate([self.means, data])
+        weights = np.concatenate([self.weights, weights])
+
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+
+        # Scale function k1: small centroids near the tails,
+        # a centroid covers at most one unit of k
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * math.pi) * np.arcsin(2 * q - 1)
+        groups = np.floor(k - k[0]).astype(np.int64)
+        _, groups = np.unique(groups, return_inverse=True)
+        groups = groups.reshape(-1)
+
+        self.weights = np.bincount(groups, weights=weights)
+        self.means = np.bincount(groups, weights=weights * means)
+        self.means /= self.weights
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def quantile(self, q):
+        '''
+        Params
+        ======
+        - q (float or np.array): Quantile(s) between 0 and 1
+        '''
+        if not self.means.size:
+            return np.nan
+
+        positions = (np.cumsum(self.weights) - self.weights / 2) / self.count
+
+        return np.interp(q, positions, self.means)
+
+
+class StreamingDetector:
+    '''
+    One pass version of the univariate detectors, the statistics
+    are computed on a bucket of any size, then the rows are scored
+    against them
+
+    The mean and the standard deviation are exact, the median,
+    the MAD and the percentiles are approximated with a t-digest
+
+    Usage
+    =====
+    detector = StreamingDetector({'method': 'stdev', ...})
+    for data in batches:
+        detector.update(data)
+    for data in batches:
+        outliers = detector.outliers(data)
+    '''
+    methods = ['stdev', 'z_score', 'mad', 'percentile']
+
+    def __init__(self, options):
+        options = dict(options)
+        self.method = options.pop('method')
+        options.pop('streaming', None)
+        self.options = options
+
+        if self.method not in self.methods:
+            raise Exception('Wrong method for streaming detection [%s], '
+                            'accept: %s' % (self.method, str(self.methods)))
+
+        trigger_on = ['low', 'high']
+        if self.method != 'percentile':
+            trigger_on.append('all')
+            options.setdefault('trigger_on', 'all')
+
+        if options.get('trigger_on') not in trigger_on:
+            raise Exception('Wrong value [%s] for [trigger_on] accept: %s'
+                            % (str(options.get('trigger_on')),
+                               str(trigger_on)))
+
+        self.moments = Moments()
+        self.digest = TDigest(options.pop('compression', 200))
+
+    def update(self, data):
+        data = _univariate(data)
+        self.moments.update(data)
+        self.digest.update(data)
+
+    def outliers(self, data):
+        '''
+        Return
+        ======
+        Index of the outliers of data, against the statistics of
+        all the data given to update
+        '''
+        data = _univariate(data)
+        median = self.digest.quantile(0.5)
+
+        if self.method == 'stdev':
+            return outliers_detection._score_stdev(
+                data, median, self.moments.std,
+                self.options['sensitivity'],
+                self.options['trigger_on']
+            )
+
+        elif self.method == 'percentile':
+            return outliers_detection._score_percentile(
+                data,
+                self.digest.quantile(self.options['sensitivity'] / 100),
+                self.options['trigger_on']
+            )
+
+        # Median of the absolute deviations, from the centroids
+        deviations = TDigest(self.digest.compression)
+        deviations.update(
+            abs(self.digest.means - median),
+            self.digest.weights
+        )
+        mad = deviations.quantile(0.5)
+
+        score = getattr(outliers_detection, '_score_' + self.method)
+
+        return score(
+            data, median, mad,
+            self.options['sensitivity'],
+            self.options['trigger_on']
+        )
+
+
+def _univariate(data):
+    if data.ndim > 2 or (data.ndim == 2 and data.shape[1] > 1):
+        raise Exception('This method accept only 1D vector')
+
+    return data.reshape(-1)
@@ -0,0 +1,130 @@
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+
+class Timings:
+    '''
+    Time spent per stage (in total and per bucket) and counters of a model
+
+    The readers and the analyzer record in the current Timings
+    (see current / recording), the prefetch thread of the reader
+    records too, so the stages can overlap
+
+    Usage
+    =====
+    with recording() as timings:
+        with stage('read'):
+            ...
+        count('rows_fetched', 1000)
+    print(timings.table())
+    '''
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.buckets = collections.OrderedDict()
+        self.bucket = '-'
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+            bucket = self.buckets.setdefault(
+                self.bucket, collections.OrderedDict())
+            bucket[name] = bucket.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, timings):
+        '''
+        Add the timings of a worker process (see to_dict)
+        '''
+        for name, seconds in timings['stages'].items():
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+        for name, n in timings['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+        for bucket, stages in timings['buckets'].items():
+            bucket = self.buckets.setdefault(bucket, collections.OrderedDict())
+            for name, seconds in stages.items():
+                bucket[name] = bucket.get(name, 0) + seconds
+
+    def to_dict(self):
+        return {
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+            'buckets': {
+                bucket: dict(stages) for bucket, stages in self.buckets.items()
+            }
+        }
+
+    def table(self, elapsed=None):
+        '''
+        Params
+        ======
+        - elapsed (float): Duration of the model, the percentages are
+                           relative to it (to the sum of the stages if
+                           None), the stages can overlap
+
+        Return
+        ======
+        The summary table of the stages and the counters
+        '''
+        total = elapsed or sum(self.stages.values()) or 1
+        lines = ['%-12s %10s %7s' % ('Stage', 'Time (s)', '%')]
+        for name, seconds in self.stages.items():
+            lines.append('%-12s %10.3f %6.1f%%'
+                         % (name, seconds, seconds * 100 / total))
+
+        lines.append(' | '.join(
+            '%s: %i' % (name, n) for name, n in self.counters.items()
+        ))
+
+        return '\n'.join(lines)
+
+
+def current():
+    '''
+    Return
+    ======
+    The Timings where the stages are recorded
+    '''
+    return current.timings
+
+
+current.timings = Timings()
+
+
+@contextmanager
+def recording(timings=None):
+    '''
+    Record the stages in a new Timings (or in the given one)
+    '''
+    previous = current.timings
+    current.timings = timings if timings is not None else Timings()
+    try:
+        yield current.timings
+    finally:
+        current.timings = previous
+
+
+@contextmanager
+def stage(name):
+    '''
+    Add the time spent in the block to the stage 'name'
+    '''
+    timings = current.timings
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def count(name, n=1):
+    current.timings.count(name, n)
@@ -62,3 +62,27 @@ def check_params(*d_args, **d_kwargs):
             return function(**params)
         return wrapper
     return decorator
+
+
+#############
+# close_all #
+#############
+def close_all(closers):
+    '''
+    Call each close function, even if the previous ones raised,
+    then raise the first error
+
+    Params
+    ======
+    - closers (list): Functions without parameters
+    '''
+    error = None
+    for close in closers:
+        try:
+            close()
+        except Exception as e:
+            if error is None:
+                error = e
+
+    if error is not None:
+        raise error
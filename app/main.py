@@ -1,31 +1,171 @@
+import io
 import os
 import yaml
 import argparse
+import traceback
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from readers.es_reader import ES
-from helpers.print_tools import print, intro_message
+from readers.cache_reader import CachedReader
+from readers.memory_reader import MemoryReader
+from helpers import query_planner
+from helpers import timing
+from helpers.print_tools import print, Progress, print_logs, \
+    disable_progress, intro_message
 from analyzers import sql_analyzer
 
 
 def main():
     args = arg_parse()
     if args['config'] == '*':
-        for conf_file in os.listdir('../conf'):
-            settings = load_settings(f"../conf/{conf_file}")
-
-            reader = load_reader(settings['reader'])
-
-            for model in settings['models']:
-                print(model['name'], type='title')
-                sql_analyzer.perform_analysis(reader, model)
+        conf_files = os.listdir('../conf')
     else:
-        settings = load_settings(f"../conf/{args['config']}")
+        conf_files = [args['config']]
 
-        reader = load_reader(settings['reader'])
+    jobs = []
+    for conf_file in conf_files:
+        settings = load_settings(f"../conf/{conf_file}")
 
         for model in settings['models']:
-            print(model['name'], type='title')
-            sql_analyzer.perform_analysis(reader, model)
+            jobs.append((settings['reader'], model))
+
+    # The models running the same query share its result
+    units = query_planner.plan(jobs)
+
+    if args['workers'] > 1 and len(units) > 1:
+        run_parallel(units, args['workers'], args['cache'], args['profile'])
+        return
+
+    readers = {}
+    for reader_params, shared_query, models in units:
+        # One reader per configuration file
+        if id(reader_params) not in readers:
+            readers[id(reader_params)] = load_reader(
+                reader_params,
+                cache=args['cache']
+            )
+
+        run_models(
+            readers[id(reader_params)],
+            shared_query,
+            models,
+            workers=args['workers'],
+            profile=args['profile']
+        )
+
+
+def run_models(reader, shared_query, models, workers=1, profile=False,
+               failures=None):
+    '''
+    Params
+    ======
+    - reader     (Reader): Reader of the models
+    - shared_query  (str): Query run once for all the models (the rows
+                           are kept in memory), None to run the models
+                           with their own query
+    - models       (list): Settings of the models
+    - workers       (int): Number of processes per model
+    - profile      (bool): Run the models in cProfile
+    - failures     (list): If given, the error of a model is added to it
+                           (model name, traceback) and the next models
+                           are run, the error is raised otherwise
+    '''
+    if shared_query is not None:
+        print('Query shared by %i models' % len(models), type='info')
+        with timing.recording() as timings:
+            with timing.stage('read'):
+                reader = MemoryReader(
+                    reader.columns(shared_query),
+                    list(reader.sql_query(shared_query))
+                )
+        print('Time per stage\n' + timings.table(), type='debug')
+
+    for model in models:
+        print(model['name'], type='title')
+        try:
+            sql_analyzer.perform_analysis(reader, model, workers=workers,
+                                          profile=profile)
+        except Exception:
+            if failures is None:
+                raise
+            failures.append((model['name'], traceback.format_exc()))
+
+
+def run_parallel(units, workers, cache=False, profile=False):
+    '''
+    Run the models in a pool of processes
+
+    The logs of the models are printed at once when they are done
+
+    Params
+    ======
+    - units   (list): List of (reader parameters, shared query, models)
+                      see query_planner.plan
+    - workers  (int): Number of processes
+    - cache   (bool): Use the cache of the query results
+    - profile (bool): Run the models in cProfile
+    '''
+    progress = Progress(
+        sum(len(models) for _, _, models in units),
+        prefix='Models',
+        unit='models',
+        every=1
+    )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_unit, *unit, cache, profile): len(unit[2])
+            for unit in units
+        }
+
+        failed = 0
+        for future in as_completed(futures):
+            logs, failures = future.result()
+            print_logs(logs)
+
+            for name, error in failures:
+                print('Model [%s] failed\n%s' % (name, error), type='error')
+            failed += len(failures)
+
+            progress.update(futures[future])
+
+    progress.end()
+
+    if failed:
+        print('%i models failed' % failed, type='error')
+
+
+def run_unit(reader_params, shared_query, models, cache=False,
+             profile=False):
+    '''
+    Run models in a worker process, with its own reader
+
+    Return
+    ======
+    (logs of the models, list of (model name, traceback) of the models
+    which failed)
+    '''
+    disable_progress()
+
+    logs = io.StringIO()
+    failures = []
+    try:
+        with redirect_stdout(logs):
+            reader = load_reader(reader_params, cache=cache)
+            run_models(reader, shared_query, models, profile=profile,
+                       failures=failures)
+
+    except Exception:
+        # Reader or shared query: none of the models ran
+        error = traceback.format_exc()
+        failures = [(model['name'], error) for model in models]
+
+    finally:
+        # The logs written before the error are kept
+        output = logs.getvalue()
+
+    return output, failures
 
 
 def load_settings(filename):
@@ -64,16 +204,62 @@ def arg_parse():
         required=True
     )
 
+    arg_parser.add_argument(
+        '--workers',
+        help='Number of processes used to run the models in parallel',
+        type=int,
+        default=1
+    )
+
+    arg_parser.add_argument(
+        '--cache',
+        help='Store the query results on disk, and reuse them',
+        dest='cache',
+        action='store_true'
+    )
+
+    arg_parser.add_argument(
+        '--no-cache',
+        help='Always run the queries (default)',
+        dest='cache',
+        action='store_false'
+    )
+
+    arg_parser.set_defaults(cache=False)
+
+    arg_parser.add_argument(
+        '--profile',
+        help='Run the models in cProfile (saved in _profile.prof)',
+        action='store_true'
+    )
+
     return vars(arg_parser.parse_args())
 
 
-def load_reader(params):
+def load_reader(params, cache=False):
+    '''
+    Params
+    ======
+    - params (dict): Parameters of the reader (configuration file)
+    - cache  (bool): Wrap the reader in a CachedReader, configured
+                     by the optional "cache" section of the reader
+    '''
     if params['type'] == 'ES':
-        return ES(params['url'], params['scroll_size'], params['timeout'])
+        reader = ES(
+            params['url'],
+            params['scroll_size'],
+            params['timeout'],
+            prefetch=params.get('prefetch', 1)
+        )
 
     else:
         raise Exception('Wrong reader type, check your configuration file')
 
+    if cache:
+        reader = CachedReader(reader, **params.get('cache', {}))
+
+    return reader
+
 
 if __name__ == '__main__':
     intro_message()
@@ -35,13 +35,69 @@ class Reader(abc.ABC):
     @abc.abstractmethod
     def n_rows(self, sql_query):
         '''
-        Return the totals number of rows in the response
+        Return the totals number of rows in the response,
+        or None if the reader can not count them cheaply
         '''
         pass
 
+    def can_count_rows(self, sql_query):
+        '''
+        Return True if the reader can give the number of rows
+        without running the whole query (see n_rows)
+        '''
+        return False
+
     @abc.abstractmethod
     def columns(self, sql_query):
         '''
         Return a list of columns name
         '''
         pass
+
+
+def bucket_rows(rows, bucket):
+    '''
+    Split the rows in buckets (see Reader.sql_query_bucket)
+
+    Params
+    ======
+    - rows    (iter): Rows, ordered by 'bucket'
+    - bucket  (list): List of column index to use to create buckets
+    '''
+    if not bucket:
+        yield '-', rows
+        return
+
+    def bucket_iter():
+        yield bucket_iter.row
+
+        for row in bucket_iter.iter:
+            bucket_value = [row[b] for b in bucket]
+
+            if bucket_value != bucket_iter.bucket_value:
+                bucket_iter.row = row
+                bucket_iter.bucket_value = bucket_value
+                break
+
+            yield row
+
+        else:
+            bucket_iter.stop = True
+
+    bucket_iter.iter = iter(rows)
+    try:
+        bucket_iter.row = next(bucket_iter.iter)
+    except StopIteration:
+        return
+    bucket_iter.bucket_value = [bucket_iter.row[b] for b in bucket]
+    bucket_iter.stop = False
+
+    while not bucket_iter.stop:
+        b_iter = bucket_iter()
+
+        yield bucket_iter.bucket_value, b_iter
+
+        # If we break the loop
+        # We should pass to the next bucket
+        for _ in b_iter:
+            pass
@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from readers.abc_reader import Reader, bucket_rows
+from helpers.sql_parser import normalize
+
+
+class CachedReader(Reader):
+    '''
+    Wrap a reader, the results of the queries are stored on disk
+    so re-running a model doesn't re-run its query
+
+    An entry is a directory with a meta.json file and the columns of each
+    chunk of rows (see _save_column), written while the rows are read.
+    The entries older than 'ttl' are ignored, and the least recently used
+    ones are removed when the cache is bigger than 'max_size' (a result
+    bigger than 'max_size' is not cached)
+
+    Params
+    ======
+    - reader    (Reader): Reader used when the query is not cached
+    - directory    (str): Directory of the cache
+    - ttl          (int): Time to live of an entry, in seconds
+    - max_size     (int): Maximum size of the cache, in bytes
+    - chunk_size   (int): Number of rows per chunk
+    '''
+    # Version of the format of the entries, the others are ignored
+    version = 2
+
+    def __init__(self, reader, directory='../cache', ttl=3600,
+                 max_size=2 * 1024 ** 3, chunk_size=10000):
+        self.reader = reader
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+    def sql_query(self, sql_query):
+        '''
+        Params
+        ======
+        - sql_query (str): SQL query sent to the reader
+
+        Usage
+        =====
+        for row in reader.sql_query(sql_query):
+            pass
+        '''
+        entry = self._entry(sql_query)
+
+        if self._is_valid(entry):
+            yield from self._read(entry)
+            return
+
+        columns = self.reader.columns(sql_query)
+        writer = _EntryWriter(self.directory, entry, self.max_size,
+                              self.chunk_size)
+        try:
+            for row in self.reader.sql_query(sql_query):
+                writer.add(row)
+                yield row
+
+        except BaseException:
+            # Error, or the loop was stopped before the end
+            writer.abort()
+            raise
+
+        # The query was read until the end
+        if writer.commit(sql_query, columns):
+            self._evict()
+
+    def sql_query_bucket(self, sql_query, bucket=[]):
+        '''
+        Params
+        ======
+        - sql_query    (str): SQL query, the rows must be ordered by 'bucket' !
+        - bucket      (list): List of column index to use to create buckets
+        '''
+        return bucket_rows(self.sql_query(sql_query), bucket)
+
+    def can_count_rows(self, sql_query):
+        if self._is_valid(self._entry(sql_query)):
+            return True
+
+        return self.reader.can_count_rows(sql_query)
+
+    def n_rows(self, sql_query):
+        entry = self._entry(sql_query)
+        if self._is_valid(entry):
+            return self._meta(entry)['n_rows']
+
+        return self.reader.n_rows(sql_query)
+
+    def columns(self, sql_query):
+        entry = self._entry(sql_query)
+        if self._is_valid(entry):
+            return self._meta(entry)['columns']
+
+        return self.reader.columns(sql_query)
+
+    def _entry(self, sql_query):
+        '''
+        Return the directory of the query
+        The key is the reader URL and the normalized SQL query (the
+        spaces of the string literals are kept)
+        '''
+        key = json.dumps([getattr(self.reader, 'url', ''),
+                          normalize(sql_query)])
+
+        return os.path.join(
+            self.directory,
+            hashlib.sha1(key.encode('utf-8')).hexdigest()
+        )
+
+    def _meta(self, entry):
+        return json.load(open(os.path.join(entry, 'meta.json')))
+
+    def _is_valid(self, entry):
+        if not os.path.isfile(os.path.join(entry, 'meta.json')):
+            return False
+
+        meta = self._meta(entry)
+        if (meta.get('version') != self.version
+                or time.time() - meta['created'] > self.ttl):
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+
+        return True
+
+    def _read(self, entry):
+        meta = self._meta(entry)
+
+        # Used for the LRU eviction
+        os.utime(os.path.join(entry, 'meta.json'))
+
+        for i_chunk, chunk in enumerate(meta['chunks']):
+            columns = [
+                _load_column(
+                    os.path.join(entry, '%i_%i' % (i_chunk, i)), dtype)
+                for i, dtype in enumerate(chunk['dtypes'])
+            ]
+
+            yield from zip(*columns)
+
+    def _evict(self):
+        '''
+        Remove the expired entries, then the least recently used
+        ones until the cache is smaller than max_size
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.endswith('.tmp') or not self._is_valid(entry):
+                continue
+
+            entries.append((
+                os.path.getmtime(os.path.join(entry, 'meta.json')),
+                self._meta(entry)['size'],
+                entry
+            ))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+
+class _EntryWriter:
+    '''
+    Write the rows of a query in a temporary entry, chunk by chunk,
+    the entry is renamed when all the rows are written (commit)
+
+    Params
+    ======
+    - directory   (str): Directory of the cache
+    - entry       (str): Directory of the entry
+    - max_size    (int): The rows are not written after this size
+    - chunk_size  (int): Number of rows per chunk
+    '''
+    def __init__(self, directory, entry, max_size, chunk_size):
+        os.makedirs(directory, exist_ok=True)
+
+        self.entry = entry
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+        # Several processes can run the same query
+        self.tmp_entry = '%s.%i.tmp' % (entry, os.getpid())
+        shutil.rmtree(self.tmp_entry, ignore_errors=True)
+        os.makedirs(self.tmp_entry)
+
+        self.rows = []
+        self.chunks = []
+        self.n_rows = 0
+        self.size = 0
+        self.too_big = False
+
+    def add(self, row):
+        if self.too_big:
+            return
+
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self._write_chunk()
+
+    def commit(self, sql_query, columns):
+        '''
+        Return
+        ======
+        True if the entry was written (not bigger than max_size)
+        '''
+        if self.rows:
+            self._write_chunk()
+
+        if self.too_big:
+            return False
+
+        meta = {
+            'version': CachedReader.version,
+            'sql_query': sql_query,
+            'columns': columns,
+            'chunks': self.chunks,
+            'n_rows': self.n_rows,
+            'created': time.time(),
+            'size': self.size
+        }
+        output = open(os.path.join(self.tmp_entry, 'meta.json'), 'w')
+        output.write(json.dumps(meta))
+        output.close()
+
+        shutil.rmtree(self.entry, ignore_errors=True)
+        try:
+            os.rename(self.tmp_entry, self.entry)
+        except OSError:
+            # Written by another process
+            self.abort()
+
+        return True
+
+    def abort(self):
+        shutil.rmtree(self.tmp_entry, ignore_errors=True)
+
+    def _write_chunk(self):
+        i_chunk = len(self.chunks)
+        dtypes = []
+        for i, values in enumerate(zip(*self.rows)):
+            dtype, size = _save_column(
+                os.path.join(self.tmp_entry, '%i_%i' % (i_chunk, i)),
+                list(values)
+            )
+            dtypes.append(dtype)
+            self.size += size
+
+        self.chunks.append({'n_rows': len(self.rows), 'dtypes': dtypes})
+        self.n_rows += len(self.rows)
+        self.rows = []
+
+        if self.size > self.max_size:
+            self.too_big = True
+            self.abort()
+
+
+def _save_column(prefix, values):
+    '''
+    Save the values of a column of a chunk:
+    - str: prefix.utf8 (the strings one after the other) and
+      prefix.offsets.npy (offset of each string, in characters)
+    - int, float, bool: prefix.npy
+    - other or mixed types: prefix.npy, pickled
+    and prefix.mask.npy, the mask of the None values (if any)
+
+    Return
+    ======
+    (dtype, size of the files in bytes)
+    '''
+    size = 0
+
+    # Not a numpy array of strings: its items have the size of the
+    # longest string
+    if set(map(type, values)) - {type(None)} == {str}:
+        mask = None
+        if None in values:
+            mask = np.array([value is None for value in values])
+            values = ['' if value is None else value for value in values]
+
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in values], out=offsets[1:])
+
+        np.save(prefix + '.offsets.npy', offsets)
+        output = open(prefix + '.utf8', 'wb')
+        output.write(''.join(values).encode('utf-8', 'surrogatepass'))
+        output.close()
+
+        dtype = 'str'
+        size += (os.path.getsize(prefix + '.offsets.npy')
+                 + os.path.getsize(prefix + '.utf8'))
+
+    else:
+        array, mask = _to_array(values)
+        np.save(prefix + '.npy', array,
+                allow_pickle=array.dtype == 'object')
+        dtype = str(array.dtype)
+        size += os.path.getsize(prefix + '.npy')
+
+    if mask is not None:
+        np.save(prefix + '.mask.npy', mask)
+        size += os.path.getsize(prefix + '.mask.npy')
+
+    return dtype, size
+
+
+def _load_column(prefix, dtype):
+    '''
+    Return
+    ======
+    The list of the values of a column of a chunk (see _save_column)
+    '''
+    if dtype == 'str':
+        offsets = np.load(prefix + '.offsets.npy').tolist()
+        text = open(prefix + '.utf8', 'rb').read().decode(
+            'utf-8', 'surrogatepass')
+        values = [
+            text[start:end] for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    else:
+        values = np.load(
+            prefix + '.npy', allow_pickle=dtype == 'object').tolist()
+
+    if os.path.isfile(prefix + '.mask.npy'):
+        mask = np.load(prefix + '.mask.npy')
+        values = [
+            None if null else value for value, null in zip(values, mask)
+        ]
+
+    return values
+
+
+def _to_array(values):
+    '''
+    Return
+    ======
+    (np.array, mask of the None values or None)
+    The array is typed if all the values are int, float or bool
+    '''
+    mask = None
+    types = set(map(type, values)) - {type(None)}
+
+    if None in values:
+        mask = np.array([value is None for value in values])
+
+    if types == {int}:
+        fill = 0
+    elif types == {float}:
+        fill = 0.
+    elif types == {bool}:
+        fill = False
+    else:
+        types = None
+
+    if types is not None:
+        if mask is not None:
+            values = [fill if value is None else value for value in values]
+        try:
+            return np.array(values), mask
+        except OverflowError:
+            pass
+
+    array = np.empty(len(values), dtype='object')
+    for i, value in enumerate(values):
+        array[i] = value
+
+    return array, mask
@@ -1,7 +1,11 @@
 import re
 import json
+import queue
+import threading
 import requests
-from readers.abc_reader import Reader
+from readers.abc_reader import Reader, bucket_rows
+from helpers import timing
+from helpers.sql_parser import top_level_matches
 
 
 class ES(Reader):
@@ -10,29 +14,72 @@ class ES(Reader):
     https://www.elastic.co/guide/en/elasticsearch/reference/6.7/sql-rest.html
     '''
     def __init__(self, url='http://127.0.0.1:9200',
-                 scroll_size=10000, timeout='90s'):
+                 scroll_size=10000, timeout='90s', prefetch=1):
+        '''
+        Params
+        ======
+        - url         (str): Url of Elasticsearch
+        - scroll_size (int): Number of rows per page
+        - timeout     (str): Timeout of a request
+        - prefetch    (int): Number of pages fetched in background while
+                             the current one is processed (0 to disable)
+        '''
         self.url = url
         self.scroll_size = scroll_size
         self.timeout = timeout
+        self.prefetch = prefetch
+        self._session = None
 
-    def _query(self, query, url='', method='GET'):
+    @property
+    def session(self):
+        '''
+        HTTP session, the connections are reused between the requests
+        Created on first use, so each process has its own
+        '''
+        if self._session is None:
+            self._session = requests.Session()
+
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _request(self, query, url='', method='GET'):
         '''
         Params
         ======
         - query (dict): Json data send to Elasticsearch
         - url    (str): Url on which we send the json
         - method (str): GET or POST
+
+        Return
+        ======
+        The HTTP response
         '''
-        if method == 'GET':
-            response = requests.get(self.url, json=query)
+        with timing.stage('fetch'):
+            if method == 'GET':
+                response = self.session.get(self.url, json=query)
 
-        elif method == 'POST':
-            response = requests.post(self.url + url, json=query)
+            elif method == 'POST':
+                response = self.session.post(self.url + url, json=query)
 
         if response.status_code != 200:
             raise Exception('Error, connection to ES')
 
-        return json.loads(response.text)
+        timing.count('bytes', len(response.content))
+
+        return response
+
+    def _query(self, query, url='', method='GET'):
+        '''
+        Same as _request, but return the decoded json
+        '''
+        response = self._request(query, url, method)
+        with timing.stage('decode'):
+            # The bytes, not response.text (no charset detection)
+            return json.loads(response.content)
 
     def sql_query(self, sql_query):
         '''
@@ -45,42 +92,110 @@ class ES(Reader):
         for row in ES.sql_query(sql_query):
             pass
         '''
+        for rows in self._pages(sql_query):
+            yield from rows
+
+    def _pages(self, sql_query):
+        '''
+        Yield the rows of each page, the next pages are fetched
+        in a background thread (see prefetch)
+        If the loop is stopped, the cursor is closed
+        '''
+        if not self.prefetch:
+            yield from self._read_pages(sql_query)
+            return
+
+        pages = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        thread = threading.Thread(
+            target=self._prefetch_pages,
+            args=(self._read_pages(sql_query), pages, stop),
+            daemon=True
+        )
+        thread.start()
+
+        try:
+            while True:
+                page = pages.get()
+
+                if page is None:
+                    break
+
+                if isinstance(page, Exception):
+                    raise page
+
+                yield page
+
+        finally:
+            stop.set()
+
+    @staticmethod
+    def _prefetch_pages(responses, pages, stop):
+        '''
+        Put the responses in the queue "pages" until "stop" is set
+        The last element is None, or the exception raised
+        '''
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for response in responses:
+                if not put(response):
+                    break
+            else:
+                put(None)
+
+        except Exception as error:
+            put(error)
+
+        finally:
+            # Close the cursor if we stopped before the end
+            responses.close()
+
+    def _read_pages(self, sql_query):
+        url = '/_xpack/sql?format=json'
         query = {
             'query': sql_query,
             'fetch_size': self.scroll_size,
             'request_timeout': self.timeout
         }
 
-        response = self._query(query, '/_xpack/sql?format=json', 'POST')
-
-        if 'rows' not in response:
-            raise Exception('Error, connection to ES')
-
-        cursor = response['cursor']
-        columns = response['columns']
-
-        n_cols = len(response['columns'])
+        response = self._query(query, url, 'POST')
+        cursor = None
 
-        for row in response['rows']:
-            yield row[:n_cols]
+        try:
+            while True:
+                if response is None or 'rows' not in response:
+                    raise Exception('Error, connection to ES')
 
-        while True:
-            response = self._query(
-                {'cursor': cursor},
-                '/_xpack/sql?format=json',
-                'POST'
-            )
+                cursor = response.get('cursor')
+                yield response['rows']
 
-            if response is None or 'rows' not in response:
-                raise Exception('Error, connection to ES')
+                if not cursor:
+                    cursor = None
+                    break
 
-            for row in response['rows']:
-                yield row[:n_cols]
+                response = self._query({'cursor': cursor}, url, 'POST')
 
-            if 'cursor' not in response:
-                break
+        finally:
+            if cursor is not None:
+                self._close_cursor(cursor)
 
-            cursor = response['cursor']
+    def _close_cursor(self, cursor):
+        '''
+        Free the resources of a cursor which was not read until the end
+        '''
+        try:
+            self._query({'cursor': cursor}, '/_xpack/sql/close', 'POST')
+        except Exception:
+            pass
 
     def sql_query_bucket(self, sql_query, bucket=[]):
         '''
@@ -95,40 +210,7 @@ class ES(Reader):
             for row in rows:
                 pass
         '''
-        if not bucket:
-            yield '-', self.sql_query(sql_query)
-
-        else:
-            def bucket_iter():
-                yield bucket_iter.row
-
-                for row in bucket_iter.iter:
-                    bucket_value = [row[b] for b in bucket]
-
-                    if bucket_value != bucket_iter.bucket_value:
-                        bucket_iter.row = row
-                        bucket_iter.bucket_value = bucket_value
-                        break
-
-                    yield row
-
-                else:
-                    bucket_iter.stop = True
-
-            bucket_iter.iter = self.sql_query(sql_query)
-            bucket_iter.row = next(bucket_iter.iter)
-            bucket_iter.bucket_value = [bucket_iter.row[b] for b in bucket]
-            bucket_iter.stop = False
-
-            while not bucket_iter.stop:
-                b_iter = bucket_iter()
-
-                yield bucket_iter.bucket_value, b_iter
-
-                # If we break the loop
-                # We should pass to the next bucket
-                for _ in b_iter:
-                    pass
+        return bucket_rows(self.sql_query(sql_query), bucket)
 
     def columns(self, sql_query):
         '''
@@ -140,6 +222,14 @@ class ES(Reader):
         ======
         A list of columns names
         '''
+        return [col['name'] for col in self._columns_metadata(sql_query)]
+
+    def _columns_metadata(self, sql_query):
+        '''
+        Return
+        ======
+        A list of {'name': column name, 'type': ES type}
+        '''
         query = {
             'query': sql_query,
             'fetch_size': self.scroll_size,
@@ -153,10 +243,67 @@ class ES(Reader):
         if 'columns' not in response:
             raise Exception('Error, connection to ES')
 
-        return [col['name'] for col in response['columns']]
+        if 'cursor' in response:
+            self._close_cursor(response['cursor'])
+
+        return response['columns']
+
+    def can_count_rows(self, sql_query):
+        '''
+        Only the queries without aggregation can be counted
+        with a single COUNT(*) query
+        '''
+        return self._count_query(sql_query) is not None
 
     def n_rows(self, sql_query):
-        total_rows = 0
-        for _ in self.sql_query(sql_query):
-            total_rows += 1
-        return total_rows
+        '''
+        Params
+        ======
+        - sql_query (str): SQL query
+
+        Return
+        ======
+        The number of rows returned by the query, or None if
+        it can not be counted without scrolling the whole query
+        '''
+        count_query = self._count_query(sql_query)
+        if count_query is None:
+            return None
+
+        query = {
+            'query': count_query,
+            'request_timeout': self.timeout
+        }
+        response = self._query(query, '/_xpack/sql?format=json', 'POST')
+
+        if 'rows' not in response or not response['rows']:
+            raise Exception('Error, connection to ES')
+
+        return response['rows'][0][0]
+
+    @staticmethod
+    def _count_query(sql_query):
+        '''
+        Build "SELECT COUNT(*) FROM ..." from the query
+        Return None if the query aggregates rows (the number of
+        groups can not be counted by ES SQL in one request)
+        '''
+        keywords = re.compile(
+            r'\b(GROUP\s+BY|HAVING|LIMIT|DISTINCT|PIVOT)\b',
+            re.IGNORECASE
+        )
+        if keywords.search(sql_query):
+            return None
+
+        # Find the top level FROM (not the one of EXTRACT(x FROM y),
+        # of a string or of a field like meta.from)
+        froms = top_level_matches(r'(?<=\s)FROM\b', sql_query)
+        if not froms:
+            return None
+
+        query = sql_query[froms[0].start():]
+        order_by = top_level_matches(r'\bORDER\s+BY\b', query)
+        if order_by:
+            query = query[:order_by[0].start()]
+
+        return 'SELECT COUNT(*) ' + query.strip()
@@ -0,0 +1,178 @@
+import json
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from helpers import timing
+
+
+class ESWriter:
+    '''
+    Index documents in Elasticsearch with _bulk requests, sent by
+    background threads so the analysis doesn't wait for ES
+
+    At most max_in_flight requests are sent at the same time, write waits
+    when they are all busy (the memory stays bounded)
+
+    The failed requests (connection error, HTTP 429 or 5xx) and the
+    documents rejected by ES because it is overloaded (status 429) are
+    retried with an exponential backoff. The documents have an id, a
+    document sent twice is replaced, not duplicated
+
+    Params
+    ======
+    - url            (str): Url of Elasticsearch
+    - index          (str): Index of the documents
+    - doc_type       (str): Type of the documents (required by ES 6),
+                            None to omit it
+    - batch_size     (int): Number of documents per _bulk request
+    - max_in_flight  (int): Maximum number of requests sent at once
+    - retries        (int): Number of retries of a request
+    - backoff      (float): Seconds before the first retry, doubled at
+                            each retry
+
+    Usage
+    =====
+    writer = ESWriter(url, 'outliers')
+    writer.write(documents, ids)
+    writer.close()
+    '''
+    def __init__(self, url='http://127.0.0.1:9200', index='outliers',
+                 doc_type='_doc', batch_size=1000, max_in_flight=2,
+                 retries=5, backoff=0.5):
+        self.url = url
+        self.index = index
+        self.doc_type = doc_type
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+
+        self.pending = []
+        self.error = None
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # One session per thread
+        self._local = threading.local()
+        self._sessions = []
+
+    def write(self, documents, ids):
+        '''
+        Params
+        ======
+        - documents (list): Documents (dict) to index
+        - ids       (list): Id of each document
+
+        The documents are sent by batches of batch_size, the last ones
+        wait for the next write (or flush)
+        '''
+        self._raise_error()
+
+        for document, doc_id in zip(documents, ids):
+            action = {'_index': self.index, '_id': doc_id}
+            if self.doc_type is not None:
+                action['_type'] = self.doc_type
+
+            self.pending.append(
+                json.dumps({'index': action}) + '\n'
+                + json.dumps(document) + '\n'
+            )
+
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        '''
+        Send the documents waiting (does not wait for the response)
+        '''
+        if not self.pending:
+            return
+
+        lines, self.pending = self.pending, []
+
+        # Wait for a free slot of the window
+        with timing.stage('write_wait'):
+            self._window.acquire()
+        future = self._executor.submit(self._send, lines)
+        future.add_done_callback(self._done)
+
+    def close(self):
+        '''
+        Send the last documents and wait for all the requests
+        Raise an exception if documents were not indexed
+        '''
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+
+        self._raise_error()
+
+    def _done(self, future):
+        self._window.release()
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+            self._sessions.append(self._local.session)
+
+        return self._local.session
+
+    def _send(self, lines):
+        '''
+        Send a _bulk request, retry it (or the documents rejected with
+        a 429 status) until all the documents are indexed
+        '''
+        for retry in range(self.retries + 1):
+            if retry:
+                time.sleep(self.backoff * 2 ** (retry - 1))
+
+            try:
+                with timing.stage('write'):
+                    response = self.session.post(
+                        self.url + '/_bulk',
+                        data=''.join(lines).encode('utf-8'),
+                        headers={'Content-Type': 'application/x-ndjson'}
+                    )
+            except requests.ConnectionError:
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                continue
+
+            if response.status_code != 200:
+                raise Exception('Error, documents not indexed in ES [%i]'
+                                % response.status_code)
+
+            items = response.json()['items']
+            rejected = [
+                line for line, item in zip(lines, items)
+                if item['index'].get('status') == 429
+            ]
+            errors = [
+                item['index']['error'] for item in items
+                if item['index'].get('status') != 429
+                and 'error' in item['index']
+            ]
+            timing.count('indexed', len(lines) - len(rejected) - len(errors))
+
+            if errors:
+                raise Exception('Error, %i documents not indexed in ES: %s'
+                                % (len(errors), errors[0]))
+
+            if not rejected:
+                return
+
+            lines = rejected
+
+        raise Exception('Error, %i documents not indexed in ES after %i '
+                        'retries' % (len(lines), self.retries))
@@ -0,0 +1,87 @@
+from readers.abc_reader import Reader, bucket_rows
+from helpers.query_planner import order_by_columns, select_aliases
+
+
+class MemoryReader(Reader):
+    '''
+    Rows of a query kept in memory, shared by the models running
+    the same query with a different ORDER BY, bucket or aliases
+
+    The ORDER BY of the query given to sql_query is done locally,
+    and sql_query_bucket groups the rows by bucket
+
+    Params
+    ======
+    - columns (list): Columns name of the shared query
+    - rows    (list): Rows returned by the shared query
+    '''
+    def __init__(self, columns, rows):
+        self._columns = list(columns)
+        self.rows = rows
+
+    def sql_query(self, sql_query):
+        '''
+        Params
+        ======
+        - sql_query (str): Query of the model, only its ORDER BY is used
+        '''
+        return iter(self._sorted(sql_query))
+
+    def sql_query_bucket(self, sql_query, bucket=[]):
+        '''
+        Params
+        ======
+        - sql_query    (str): Query of the model, only its ORDER BY is used
+        - bucket      (list): List of column index to use to create buckets
+        '''
+        rows = self._sorted(sql_query)
+
+        # The rows of a bucket must follow each other (stable sort,
+        # the ORDER BY is kept inside a bucket)
+        if bucket:
+            rows = sorted(rows, key=lambda row: [
+                _sort_key(row[b]) for b in bucket
+            ])
+
+        return bucket_rows(iter(rows), bucket)
+
+    def can_count_rows(self, sql_query):
+        return True
+
+    def n_rows(self, sql_query):
+        return len(self.rows)
+
+    def columns(self, sql_query):
+        '''
+        The columns are named with the aliases of the query
+        '''
+        aliases = select_aliases(sql_query)
+
+        return [
+            alias or column for alias, column in zip(aliases, self._columns)
+        ]
+
+    def _sorted(self, sql_query):
+        order = order_by_columns(sql_query)
+        if order is None:
+            raise ValueError('The ORDER BY can not be done locally')
+
+        rows = self.rows
+        # Stable sort, from the last key to the first one
+        for index, descending in reversed(order):
+            # Like ES, the null values are at the end in both directions
+            values = [row for row in rows if row[index] is not None]
+            nulls = [row for row in rows if row[index] is None]
+
+            rows = sorted(
+                values,
+                key=lambda row: row[index],
+                reverse=descending
+            ) + nulls
+
+        return rows
+
+
+def _sort_key(value):
+    # Like ES, the null values are at the end
+    return (value is None, value)
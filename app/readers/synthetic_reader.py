@@ -0,0 +1,120 @@
+import numpy as np
+from readers.abc_reader import Reader, bucket_rows
+
+
+DISTRIBUTIONS = ['normal', 'lognormal', 'uniform', 'exponential']
+
+
+class SyntheticReader(Reader):
+    '''
+    Random rows, to run the models without Elasticsearch (benchmarks)
+
+    The query is ignored, the rows are (bucket, value_1, ..., value_n,
+    label), ordered by bucket, the buckets have about the same size
+
+    Params
+    ======
+    - n_rows        (int): Number of rows
+    - n_buckets     (int): Number of distinct buckets
+    - n_targets     (int): Number of value columns
+    - distribution  (str): normal, lognormal, uniform or exponential
+    - outliers    (float): Fraction of the values multiplied by 10
+    - seed          (int): Seed of the random generator
+    - chunk_size    (int): Number of rows generated at once
+    '''
+    def __init__(self, n_rows, n_buckets=1, n_targets=1,
+                 distribution='normal', outliers=0.001, seed=0,
+                 chunk_size=100000):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError('Wrong distribution [%s], accept: %s'
+                             % (distribution, str(DISTRIBUTIONS)))
+
+        self.total_rows = n_rows
+        self.n_buckets = n_buckets
+        self.n_targets = n_targets
+        self.distribution = distribution
+        self.outliers = outliers
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def sql_query(self, sql_query):
+        '''
+        Params
+        ======
+        - sql_query (str): Ignored
+
+        Usage
+        =====
+        for row in reader.sql_query(sql_query):
+            pass
+        '''
+        random = np.random.RandomState(self.seed)
+
+        for start in range(0, self.total_rows, self.chunk_size):
+            size = min(self.chunk_size, self.total_rows - start)
+
+            # Rows ordered by bucket
+            buckets = (np.arange(start, start + size)
+                       * self.n_buckets // self.total_rows)
+            values = [
+                synthetic_values(size, self.distribution,
+                                 self.outliers, random).tolist()
+                for _ in range(self.n_targets)
+            ]
+            labels = random.randint(0, 1000, size)
+
+            yield from zip(
+                ['bucket_%i' % bucket for bucket in buckets],
+                *values,
+                ['label_%i' % label for label in labels]
+            )
+
+    def sql_query_bucket(self, sql_query, bucket=[]):
+        '''
+        Params
+        ======
+        - sql_query    (str): Ignored
+        - bucket      (list): List of column index to use to create buckets
+        '''
+        return bucket_rows(self.sql_query(sql_query), bucket)
+
+    def can_count_rows(self, sql_query):
+        return True
+
+    def n_rows(self, sql_query):
+        return self.total_rows
+
+    def columns(self, sql_query):
+        if self.n_targets == 1:
+            values = ['value']
+        else:
+            values = ['value_%i' % (i + 1) for i in range(self.n_targets)]
+
+        return ['bucket'] + values + ['label']
+
+
+def synthetic_values(size, distribution='normal', outliers=0.001,
+                     random=None):
+    '''
+    Return
+    ======
+    np.array of random values, a fraction 'outliers' of them is
+    multiplied by 10
+    '''
+    if random is None:
+        random = np.random.RandomState(0)
+
+    if distribution == 'normal':
+        values = random.normal(100, 10, size)
+    elif distribution == 'lognormal':
+        values = random.lognormal(3, 1, size)
+    elif distribution == 'uniform':
+        values = random.uniform(0, 100, size)
+    elif distribution == 'exponential':
+        values = random.exponential(10, size)
+    else:
+        raise ValueError('Wrong distribution [%s]' % distribution)
+
+    values[random.random_sample(size) < outliers] *= 10
+
+    return values
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are imported from app/, like main.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,179 @@
+import pytest
+
+from helpers import query_planner
+from helpers.sql_parser import top_level_matches, normalize
+from readers.memory_reader import MemoryReader
+
+
+# (text, pattern, parenthesis, text from each match)
+TOP_LEVEL_MATCHES = [
+    ("SELECT a FROM t WHERE b = 'x FROM y'", r'\bFROM\b', True,
+     ["FROM t WHERE b = 'x FROM y'"]),
+    ('SELECT EXTRACT(YEAR FROM d), f(g(x FROM y)) FROM t', r'\bFROM\b',
+     True, ['FROM t']),
+    ('SELECT "FROM", `FROM` FROM t', r'\bFROM\b', True, ['FROM t']),
+    ("SELECT 'it''s FROM' FROM t", r'\bFROM\b', True, ['FROM t']),
+    ('SELECT a, f(b, c), d FROM t', ',', True,
+     [', f(b, c), d FROM t', ', d FROM t']),
+    ("HAVING (occurs) < 5 AND 'occurs' = x", r'occurs', False,
+     ['occurs) < 5 AND \'occurs\' = x']),
+    ('HAVING (occurs) < 5', r'occurs', True, []),
+]
+
+
+@pytest.mark.parametrize('text, pattern, parenthesis, expected',
+                         TOP_LEVEL_MATCHES)
+def test_top_level_matches(text, pattern, parenthesis, expected):
+    matches = top_level_matches(pattern, text, parenthesis=parenthesis)
+
+    assert [text[match.start():] for match in matches] == expected
+
+
+def test_normalize_keeps_the_literals():
+    assert (normalize("SELECT  a\n FROM t WHERE b = 'p  q' ")
+            == "SELECT a FROM t WHERE b = 'p  q'")
+
+
+# (query, ORDER BY columns: (index, descending) or None)
+ORDER_BY_COLUMNS = [
+    ('SELECT a, b FROM t', []),
+    ('SELECT a, b FROM t ORDER BY b DESC, a', [(1, True), (0, False)]),
+    ('SELECT a AS x, b FROM t ORDER BY x asc', [(0, False)]),
+    ('SELECT CAST(t AS FLOAT) AS time, v FROM x ORDER BY time DESC',
+     [(0, True)]),
+    ('SELECT CAST(t AS FLOAT) AS time FROM x ORDER BY CAST(t AS FLOAT)',
+     [(0, False)]),
+    ("SELECT a, b FROM t WHERE c = 'ORDER BY b' ORDER BY a", [(0, False)]),
+    ("SELECT a, b FROM t WHERE c = 'ORDER BY b'", []),
+    ('SELECT a AS "my a" FROM t ORDER BY "my a" DESC', [(0, True)]),
+    ('SELECT a FROM t ORDER BY z', None),
+    ('SELECT * FROM t ORDER BY a', None),
+]
+
+
+@pytest.mark.parametrize('sql_query, expected', ORDER_BY_COLUMNS)
+def test_order_by_columns(sql_query, expected):
+    assert query_planner.order_by_columns(sql_query) == expected
+
+
+# (query, aliases of the selected columns)
+SELECT_ALIASES = [
+    ('SELECT a, b AS y FROM t', [None, 'y']),
+    ('SELECT CAST(t AS FLOAT) AS time FROM x', ['time']),
+    ('SELECT CAST(t AS FLOAT) FROM x', [None]),
+    ("SELECT CONCAT(a, ' AS b') AS c FROM x", ['c']),
+    ('SELECT EXTRACT(YEAR FROM d) AS y, meta.from FROM t', ['y', None]),
+]
+
+
+@pytest.mark.parametrize('sql_query, expected', SELECT_ALIASES)
+def test_select_aliases(sql_query, expected):
+    assert query_planner.select_aliases(sql_query) == expected
+
+
+# (query, query without the aliases)
+STRIP_ALIASES = [
+    ('SELECT a FROM t', 'SELECT a FROM t'),
+    ('SELECT a AS x, COUNT(*) AS c FROM t GROUP BY a',
+     'SELECT a, COUNT(*) FROM t GROUP BY a'),
+    ('SELECT CAST(t AS FLOAT) AS time FROM x',
+     'SELECT CAST(t AS FLOAT) FROM x'),
+    ("SELECT a AS x FROM t WHERE b = 'p  AS  q'",
+     "SELECT a FROM t WHERE b = 'p  AS  q'"),
+]
+
+
+@pytest.mark.parametrize('sql_query, expected', STRIP_ALIASES)
+def test_strip_aliases(sql_query, expected):
+    assert query_planner._strip_aliases(sql_query) == expected
+
+
+# (queries of the models, readers, expected units: (shared query or None,
+# index of the models))
+PLAN = [
+    # ORDER BY and aliases removed
+    (['SELECT a AS x, b FROM t ORDER BY x',
+      'SELECT a, b AS y FROM t ORDER BY y DESC'],
+     [1, 1],
+     [('SELECT a, b FROM t', [0, 1])]),
+    # One model: its own query
+    (['SELECT a, b FROM t ORDER BY a'], [1],
+     [(None, [0])]),
+    # LIMIT or an ORDER BY on a column not selected
+    (['SELECT a FROM t ORDER BY a LIMIT 10',
+      'SELECT a FROM t ORDER BY a LIMIT 10',
+      'SELECT a FROM t ORDER BY b',
+      'SELECT a FROM t ORDER BY b'],
+     [1, 1, 1, 1],
+     [(None, [0]), (None, [1]), (None, [2]), (None, [3])]),
+    # Other reader
+    (['SELECT a FROM t', 'SELECT a FROM t'], [1, 2],
+     [(None, [0]), (None, [1])]),
+    # The HAVING refers to the aliases: only identical queries are shared
+    (['SELECT a AS n, COUNT(*) AS occurs FROM t GROUP BY a '
+      'HAVING occurs < 5',
+      'SELECT a AS name, COUNT(*) AS occurs FROM t GROUP BY a '
+      'HAVING occurs < 5 ORDER BY name',
+      'SELECT a AS n, COUNT(*) AS occurs FROM t GROUP BY a '
+      'HAVING occurs < 5 ORDER BY occurs DESC'],
+     [1, 1, 1],
+     [('SELECT a AS n, COUNT(*) AS occurs FROM t GROUP BY a '
+       'HAVING occurs < 5', [0, 2]),
+      (None, [1])]),
+    # An alias in a string literal is not a reference
+    (["SELECT a AS n FROM t WHERE b = 'n'",
+      "SELECT a AS m FROM t WHERE b = 'n'"],
+     [1, 1],
+     [("SELECT a FROM t WHERE b = 'n'", [0, 1])]),
+    # The spaces of the literals are kept
+    (["SELECT a FROM t WHERE b = 'p  q'",
+      "SELECT a FROM t WHERE b = 'p q'"],
+     [1, 1],
+     [(None, [0]), (None, [1])]),
+]
+
+
+@pytest.mark.parametrize('queries, readers, expected', PLAN)
+def test_plan(queries, readers, expected):
+    reader_params = {i: {'type': 'ES', 'url': str(i)} for i in set(readers)}
+    models = [{'sql_query': query} for query in queries]
+    jobs = [
+        (reader_params[reader], model)
+        for reader, model in zip(readers, models)
+    ]
+
+    units = query_planner.plan(jobs)
+
+    # Identical models are equal dicts: find them by identity
+    index = {id(model): i for i, model in enumerate(models)}
+    assert [
+        (shared_query, [index[id(model)] for model in unit_models])
+        for _, shared_query, unit_models in units
+    ] == expected
+
+
+ROWS = [(1, 'b'), (2, None), (3, 'a'), (4, 'b'), (5, None)]
+
+# (ORDER BY, index of the rows): the nulls are last in both directions
+MEMORY_ORDER = [
+    ('', [1, 2, 3, 4, 5]),
+    ('ORDER BY s', [3, 1, 4, 2, 5]),
+    ('ORDER BY s DESC', [1, 4, 3, 2, 5]),
+    ('ORDER BY s DESC, i DESC', [4, 1, 3, 5, 2]),
+    ('ORDER BY s, i DESC', [3, 4, 1, 5, 2]),
+]
+
+
+@pytest.mark.parametrize('order_by, expected', MEMORY_ORDER)
+def test_memory_reader_order(order_by, expected):
+    reader = MemoryReader(['i', 's'], ROWS)
+    rows = reader.sql_query('SELECT i, s FROM t ' + order_by)
+
+    assert [row[0] for row in rows] == expected
+
+
+def test_memory_reader_columns():
+    reader = MemoryReader(['a', 'COUNT(*)'], ROWS)
+
+    assert (reader.columns('SELECT a AS name, COUNT(*) FROM t GROUP BY a')
+            == ['name', 'COUNT(*)'])
@@ -1,14 +1,33 @@
 import os
 import re
+import sys
 import json
 import math
 import shutil
-from flask import Flask, render_template, send_from_directory, redirect
+import threading
+from flask import Flask, render_template, send_from_directory, redirect, \
+    request
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'app'))
+from helpers import plotter  # noqa: E402
+from helpers.plot_index import PlotIndex  # noqa: E402
 
 
 app = Flask(__name__)
 
 
+def plot_index(use_case):
+    '''
+    Index of the plots of the use case, built from the json
+    files if the plots were made before the index existed
+    '''
+    index = PlotIndex('../plots/' + use_case)
+    if not index.exists():
+        index.rebuild()
+
+    return index
+
+
 @app.route('/page/<use_case>/<int:page_size>/<int:page_number>/<int:hide_no_outlier>/<int:hide_one_col>')
 @app.route('/page/<use_case>/<int:page_size>/<int:page_number>/<int:hide_no_outlier>/<int:hide_one_col>/<search>')
 def page(use_case, page_size, page_number,
@@ -17,37 +36,26 @@ def page(use_case, page_size, page_number,
     if use_case not in use_cases:
         return 'Wrong use case'
 
-    files = os.listdir('../plots/' + use_case)
-    files = [f for f in files if f != '_general.json']
-
-    data = {}
-
-    for f in files:
-        plot = '.'.join(f.split('.')[:-1])
+    sort = request.args.get('sort', 'name')
+    if sort not in PlotIndex.sort_columns:
+        return 'Wrong sort'
 
-        if plot not in data:
-            data[plot] = {}
+    with plot_index(use_case) as index:
+        total_plots, plots = index.search(
+            page_size,
+            page_number,
+            hide_no_outlier=hide_no_outlier,
+            hide_one_col=hide_one_col,
+            search=search,
+            sort=sort
+        )
 
-        if f.endswith('.json'):
-            j = json.load(open('../plots/' + use_case + '/' + f))
-            data[plot].update(j)
-        elif f.endswith('.svg'):
-            data[plot]['img'] = use_case + '/' + f
+    data = {}
+    for plot in plots:
+        plot['img'] = (use_case + '/' + plot['name'] + '.'
+                       + plot.get('format', 'svg'))
+        data[plot['name']] = plot
 
-    data = {
-        k: data[k] for k in data
-        if not (hide_no_outlier and not data[k]['n_outliers'])
-        and not (hide_one_col and data[k]['one_col'])
-    }
-    if len(search):
-        data = {
-            k: data[k] for k in data
-            if search.lower() in k.lower()
-        }
-    total_plots = len(data)
-    keys = sorted(list(data.keys()))
-    keys = keys[page_number * page_size:(page_number + 1) * page_size]
-    data = {k: data[k] for k in keys}
     data = {
         'plots': data,
         'n_pages': math.ceil(total_plots / page_size)
@@ -62,26 +70,61 @@ def files(use_case, file):
     if use_case not in use_cases:
         return 'Wrong use case'
 
-    files = os.listdir('../plots/' + use_case)
+    directory = '../plots/' + use_case + '/'
 
-    if file not in files or not (file.endswith('.svg') or file.endswith('.json')):
+    name, extension = os.path.splitext(file)
+    if extension not in ['.svg', '.png', '.json']:
+        return 'Error'
+
+    # Plot not drawn during the analysis (plotting.render)
+    if not os.path.isfile(directory + file) and extension != '.json':
+        if (not os.path.isfile(directory + name + '.json')
+                or not render_plot(directory + name, extension)):
+            return 'Error'
+
+    elif not os.path.isfile(directory + file):
         return 'Error'
 
     return send_from_directory('../plots/' + use_case, file)
 
 
+def render_plot(filename, extension='.svg'):
+    '''
+    Draw the SVG (or PNG) of a plot from the histogram data of its
+    json file, the image is kept for the next requests
+
+    Return
+    ======
+    False if the json file has no histogram data (older plots)
+    '''
+    metadata = json.load(open(filename + '.json'))
+    if 'histogram' not in metadata:
+        return False
+
+    # pyplot is not thread safe, the figure is reused
+    with render_plot.lock:
+        if not os.path.isfile(filename + extension):
+            plotter.draw(metadata['histogram'], filename=filename + extension)
+
+    return True
+
+
+render_plot.lock = threading.Lock()
+
+
 @app.route('/use_case/<use_case>')
 def use_case(use_case):
     use_cases = os.listdir('../plots')
     if use_case not in use_cases:
         return 'Wrong use case'
 
-    files = os.listdir('../plots/' + use_case)
+    with plot_index(use_case) as index:
+        n_plots, _ = index.summary()
 
     return render_template(
         'use_case.html.j2',
         use_case=use_case,
-        n_files=(len(files) - 1) // 2
+        n_files=n_plots
     )
 
 
@@ -105,11 +148,8 @@ def index():
     }
 
     for use_case in use_cases:
-        metadata[use_case]['n_outliers'] = 0
-        for file in os.listdir('../plots/' + use_case):
-            if file.endswith('.json') and not file.startswith('_'):
-                tmp = json.load(open('../plots/' + use_case + '/' + file))
-                metadata[use_case]['n_outliers'] += tmp['n_outliers']
+        with plot_index(use_case) as index:
+            _, metadata[use_case]['n_outliers'] = index.summary()
 
     return render_template(
         'index.html.j2',